@@ -1,12 +1,24 @@
 """GitLab Runner helper library for charm operations."""
-import fileinput
+import hashlib
+import json
+import os
+import re
+import signal
 import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from socket import gethostname
 
 from charmhelpers.core import hookenv, templating, unitdata
-from charmhelpers.core.host import add_user_to_group, get_distrib_codename, service
+from charmhelpers.core.host import add_user_to_group, get_distrib_codename, mkdir, service, write_file
 from charmhelpers.fetch import add_source, apt_install, apt_update
 
+import yaml
+
+from runnerautoscaler import config_lock, running_jobs, scaled_limit
+from runnerconfig import RunnerConfig
+
 
 class GitLabRunner:
     """Provide various charm helper methods to installing and configuring GitLab Runner."""
@@ -17,11 +29,28 @@ class GitLabRunner:
         self.kv = unitdata.kv()
         self.gitlab_token = False
         self.gitlab_uri = False
+        self.registration_results = {}
         self.hostname = gethostname()
         self.executor_dir = "/opt/lxd-executor"
+        self.state_dir = "/var/lib/lxd-executor"
+        self.systemd_dir = "/etc/systemd/system"
         self.gitlab_user = "gitlab-runner"
         self.runner_cfg_file = "/etc/gitlab-runner/config.toml"
+        self.docker_daemon_file = "/etc/docker/daemon.json"
+        self.registry_cfg_file = "/etc/docker/registry/config.yml"
         self.apt_key = "3F01618A51312F3F"
+        self.apt_lists_dir = "/var/lib/apt/lists"
+        self.apt_sources_file = "/etc/apt/sources.list"
+        self.apt_sources_dir = "/etc/apt/sources.list.d"
+        self.drain_poll_interval = 10
+        self.proc_dir = "/proc"
+        self.job_memory_gib = 2
+        self.storage_packages = {
+            "zfs": ["zfsutils-linux"],
+            "btrfs": ["btrfs-progs"],
+            "lvm": ["lvm2"],
+            "lvm-thin": ["lvm2", "thin-provisioning-tools"],
+        }
         if self.charm_config["gitlab-token"]:
             self.gitlab_token = self.charm_config["gitlab-token"]
         else:
@@ -31,43 +60,85 @@ class GitLabRunner:
         else:
             self.gitlab_uri = self.kv.get("gitlab_uri", None)
 
-    def register(self):
-        """Register this GitLab runner with the GitLab CI server."""
-        if self.gitlab_token and self.gitlab_uri:
-            hookenv.log("Registering GitLab runner with {}".format(self.gitlab_uri))
-            hookenv.status_set("maintenance", "Registering with GitLab")
-            # Docker executor
-            command = [
-                "/usr/bin/gitlab-runner",
-                "register",
-                "--non-interactive",
-                "--url",
-                "{}".format(self.gitlab_uri),
-                "--registration-token",
-                "{}".format(self.gitlab_token),
-                "--name",
-                "{}-docker".format(self.hostname),
-                "--tag-list",
-                "docker",
+    def extra_runners(self):
+        """Return the runners listed in the runners option, by runner name. Invalid entries are logged and skipped."""
+        text = self.charm_config["runners"]
+        if not text.strip():
+            return {}
+        try:
+            entries = yaml.safe_load(text)
+        except yaml.YAMLError as error:
+            hookenv.log("Ignoring the runners option, it is not valid YAML: {}".format(error), hookenv.ERROR)
+            return {}
+        if not isinstance(entries, list):
+            hookenv.log("Ignoring the runners option, it is not a list of runners", hookenv.ERROR)
+            return {}
+        runners = {}
+        for index, entry in enumerate(entries):
+            limit = entry.get("limit", 0) if isinstance(entry, dict) else None
+            if not isinstance(entry, dict) or not entry.get("uri") or not entry.get("token") \
+                    or entry.get("executor", "lxd") not in ["docker", "lxd"] \
+                    or not str(limit).isdigit() or isinstance(limit, bool):
+                hookenv.log(
+                    "Ignoring runners entry {}, it needs a uri, a token, a docker or lxd executor and a "
+                    "limit of 0 or more".format(index),
+                    hookenv.ERROR,
+                )
+                continue
+            executor = entry.get("executor", "lxd")
+            tags = entry.get("tags", executor)
+            if isinstance(tags, list):
+                tags = ",".join(str(tag) for tag in tags)
+            digest = hashlib.sha256("{} {} {}".format(entry["uri"], entry["token"], tags).encode()).hexdigest()
+            suffix = str(entry.get("name") or "{}-{}".format(executor, digest[:8]))
+            name = "{}-{}".format(self.hostname, suffix)
+            # The docker and lxd names belong to the runners of gitlab-uri and gitlab-token.
+            if suffix in ["docker", "lxd"] or name in runners:
+                hookenv.log(
+                    "Ignoring runners entry {}, the name {} is reserved or already in use".format(index, suffix),
+                    hookenv.ERROR,
+                )
+                continue
+            runners[name] = {
+                "uri": str(entry["uri"]),
+                "token": str(entry["token"]),
+                "tags": str(tags),
+                "executor": executor,
+                "limit": int(limit),
+            }
+        return runners
+
+    def runners(self):
+        """Return the runners this unit provides, by runner name.
+
+        gitlab-uri and gitlab-token, or the runner relation, give a Docker and an LXD runner, and each
+        entry of the runners option one more, for any GitLab instance or group. They all share the
+        concurrent jobs of the unit.
+        """
+        runners = {}
+        if self.gitlab_uri and self.gitlab_token:
+            for executor in ["docker", "lxd"]:
+                runners["{}-{}".format(self.hostname, executor)] = {
+                    "uri": self.gitlab_uri,
+                    "token": self.gitlab_token,
+                    "tags": executor,
+                    "executor": executor,
+                    "limit": None,
+                }
+        runners.update(self.extra_runners())
+        return runners
+
+    def runner_commands(self):
+        """Return the gitlab-runner register command of each runner this unit provides, by runner name."""
+        commands = {}
+        executors = {
+            "docker": [
                 "--executor",
                 "docker",
                 "--docker-image",
                 "ubuntu:latest",
-            ]
-            subprocess.check_call(command, stderr=subprocess.STDOUT)
-            # LXD executor
-            command = [
-                "/usr/bin/gitlab-runner",
-                "register",
-                "--non-interactive",
-                "--url",
-                "{}".format(self.gitlab_uri),
-                "--registration-token",
-                "{}".format(self.gitlab_token),
-                "--name",
-                "{}-lxd".format(self.hostname),
-                "--tag-list",
-                "lxd",
+            ],
+            "lxd": [
                 "--executor",
                 "custom",
                 "--builds-dir",
@@ -80,17 +151,121 @@ class GitLabRunner:
                 "/opt/lxd-executor/prepare.sh",
                 "--custom-cleanup-exec",
                 "/opt/lxd-executor/cleanup.sh",
-            ]
-            subprocess.check_call(command, stderr=subprocess.STDOUT)
-        else:
+            ],
+        }
+        for name, runner in self.runners().items():
+            commands[name] = [
+                "/usr/bin/gitlab-runner",
+                "register",
+                "--non-interactive",
+                "--url",
+                "{}".format(runner["uri"]),
+                "--registration-token",
+                "{}".format(runner["token"]),
+                "--name",
+                name,
+                "--tag-list",
+                runner["tags"],
+            ] + executors[runner["executor"]]
+        return commands
+
+    def configured_runners(self):
+        """Return the [[runners]] entries of the gitlab-runner configuration, by runner name."""
+        return {runner["name"]: runner for runner in RunnerConfig(self.runner_cfg_file).runners}
+
+    def _register_runner(self, command):
+        """Register one runner into a scratch configuration file and return its [[runners]] section.
+
+        Concurrent registrations would overwrite each other in the shared config.toml, so each
+        one writes its own file and the sections are merged afterwards.
+        """
+        fd, scratch_cfg = tempfile.mkstemp(suffix=".toml", dir=os.path.dirname(self.runner_cfg_file))
+        os.close(fd)
+        try:
+            subprocess.check_call(command + ["--config", scratch_cfg], stderr=subprocess.STDOUT)
+            with open(scratch_cfg, "r") as cfg_file:
+                contents = cfg_file.read()
+        except subprocess.CalledProcessError as error:
+            # The command holds the registration token, so it is not logged.
+            hookenv.log("gitlab-runner register exited with {}".format(error.returncode), hookenv.ERROR)
+            return None
+        finally:
+            os.remove(scratch_cfg)
+        if "[[runners]]" not in contents:
+            return None
+        return contents[contents.index("[[runners]]"):]
+
+    def pending_runners(self):
+        """Return the register command and its digest of each runner that is missing or registered differently.
+
+        A runner is registered when it is in the GitLab Runner configuration and was registered with the
+        same command, which is recorded by its digest.
+        """
+        configured = self.configured_runners()
+        registered = self.kv.get("registered_runners", {})
+        pending = {}
+        for name, command in self.runner_commands().items():
+            digest = hashlib.sha256(json.dumps(command).encode()).hexdigest()
+            if name in configured and registered.get(name) == digest:
+                hookenv.log("Runner {} is already registered".format(name))
+                continue
+            pending[name] = (command, digest)
+        return pending
+
+    def register(self):
+        """Register any runners this unit provides that are missing from the GitLab Runner configuration.
+
+        Runners registered with the same settings are kept with their existing tokens, runners whose
+        settings changed are re-registered, and the registrations needed are run concurrently. Runners
+        this unit no longer provides are unregistered. The outcome for each runner is kept in
+        registration_results. Returns whether every runner is registered.
+        """
+        commands = self.runner_commands()
+        configured = self.configured_runners()
+        for name in self.kv.get("registered_runners", {}):
+            if name not in commands and name in configured:
+                hookenv.log("Unregistering runner {}, it is no longer configured".format(name))
+                self.unregister(name)
+        if not commands:
             hookenv.log("Could not register gitlab runner due to missing token or uri")
             hookenv.status_set("blocked", "Unregistered due to missing token or URI")
             return False
-        hookenv.status_set(
-            "active", "Registered with {}".format(self.gitlab_uri.lstrip("http://"))
-        )
+        pending = self.pending_runners()
+        self.registration_results = {name: "already registered" for name in commands if name not in pending}
+        for name in pending:
+            if name in configured:
+                self.unregister(name)
+        registered = self.kv.get("registered_runners", {})
+        if pending:
+            hookenv.log("Registering GitLab runners {}".format(", ".join(pending)))
+            hookenv.status_set("maintenance", "Registering with GitLab")
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                sections = executor.map(self._register_runner, [command for command, _ in pending.values()])
+                results = dict(zip(pending, sections))
+            with config_lock(self.runner_cfg_file):
+                config = RunnerConfig(self.runner_cfg_file)
+                for name, section in results.items():
+                    if section is None:
+                        hookenv.log("Registration of runner {} wrote no configuration".format(name), hookenv.ERROR)
+                        self.registration_results[name] = "failed"
+                        continue
+                    config.add_runners(section)
+                    registered[name] = pending[name][1]
+                    self.registration_results[name] = "registered"
+                self.apply_runner_settings(config)
+                config.save()
+            self.kv.set("registered_runners", registered)
+        if "failed" in self.registration_results.values():
+            hookenv.status_set("blocked", "Registration of some runners failed")
+            return False
+        self.set_registered_status()
         return True
 
+    def set_registered_status(self):
+        """Set the workload status of a unit whose runners are registered."""
+        uris = sorted(set(runner["uri"].lstrip("http://") for runner in self.runners().values()))
+        hookenv.status_set("active", "Registered with {}".format(", ".join(uris)))
+
     def add_sources(self):
         """Add APT sources to allow installation of GitLab Runner from GitLab's packages."""
         # https://packages.gitlab.com/runner/gitlab-runner/gpgkey
@@ -115,79 +290,657 @@ class GitLabRunner:
         add_user_to_group(self.gitlab_user, "docker")
         service("enable", "docker")
         service("start", "docker")
+        self.configure_docker_daemon()
+
+    def docker_daemon_config(self):
+        """Return the Docker daemon settings derived from the charm configuration."""
+        daemon = {}
+        mirrors = []
+        if self.charm_config["local-cache"]:
+            mirrors.append("http://127.0.0.1:5000")
+        mirrors.extend(self.charm_config["docker-registry-mirrors"].split())
+        if mirrors:
+            daemon["registry-mirrors"] = mirrors
+        if self.charm_config["docker-max-concurrent-downloads"]:
+            daemon["max-concurrent-downloads"] = self.charm_config["docker-max-concurrent-downloads"]
+        if self.charm_config["docker-storage-driver"]:
+            daemon["storage-driver"] = self.charm_config["docker-storage-driver"]
+        return daemon
+
+    def configure_docker_daemon(self):
+        """Write the Docker daemon configuration, restarting Docker only when it changed."""
+        content = json.dumps(self.docker_daemon_config(), indent=2, sort_keys=True) + "\n"
+        if os.path.exists(self.docker_daemon_file):
+            with open(self.docker_daemon_file, "r") as daemon_file:
+                if daemon_file.read() == content:
+                    return False
+        hookenv.log("Updating Docker daemon configuration")
+        write_file(self.docker_daemon_file, content.encode(), perms=0o644)
+        service("restart", "docker")
+        return True
+
+    def configure_local_cache(self):
+        """Run local pull-through caches for apt packages, Docker images and LXD images."""
+        if self.charm_config["local-cache"]:
+            hookenv.log("Enabling local apt, Docker registry and LXD image caches")
+            apt_install(["apt-cacher-ng", "docker-registry"])
+            templating.render("registry-config.yml.j2", self.registry_cfg_file, context={})
+            for name in ["apt-cacher-ng", "docker-registry"]:
+                service("enable", name)
+                service("restart", name)
+            # The LXD image store is the pull-through cache for images, keep them around longer.
+            command = ["lxc", "config", "set", "images.remote_cache_expiry", "30"]
+        else:
+            for name in ["apt-cacher-ng", "docker-registry"]:
+                service("stop", name)
+                service("disable", name)
+            command = ["lxc", "config", "unset", "images.remote_cache_expiry"]
+        subprocess.check_call(command, stderr=subprocess.STDOUT)
+        self.configure_docker_daemon()
+
+    def apt_index_fresh(self):
+        """Return whether the APT package index is newer than apt-update-max-age and every APT source."""
+        max_age = self.charm_config["apt-update-max-age"] * 60
+        try:
+            updated = os.stat(self.apt_lists_dir).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - updated > max_age:
+            return False
+        sources = [self.apt_sources_file]
+        if os.path.isdir(self.apt_sources_dir):
+            sources.extend(os.path.join(self.apt_sources_dir, name) for name in os.listdir(self.apt_sources_dir))
+        for source in sources:
+            try:
+                if os.stat(source).st_mtime > updated:
+                    return False
+            except FileNotFoundError:
+                continue
+        return True
+
+    def package_versions(self, package):
+        """Return the installed and candidate versions of an APT package, each None when there is none."""
+        try:
+            output = subprocess.check_output(
+                ["apt-cache", "policy", package], stderr=subprocess.DEVNULL
+            ).decode()
+        except subprocess.CalledProcessError:
+            return None, None
+        versions = {}
+        for line in output.splitlines():
+            key, sep, value = line.strip().partition(":")
+            if sep and key in ["Installed", "Candidate"]:
+                versions[key] = None if value.strip() == "(none)" else value.strip()
+        return versions.get("Installed"), versions.get("Candidate")
+
+    def active_jobs(self):
+        """Return the number of running jobs, counted the same way as by the autoscaler."""
+        return running_jobs(self.state_dir)
+
+    def runner_pid(self):
+        """Return the PID of the running GitLab Runner service, or None."""
+        output = subprocess.check_output(
+            ["systemctl", "show", "--property", "MainPID", "gitlab-runner"], stderr=subprocess.DEVNULL
+        ).decode()
+        _, _, pid = output.strip().partition("=")
+        return int(pid) if pid.isdigit() and int(pid) else None
+
+    def drain(self):
+        """Stop GitLab Runner gracefully, waiting up to upgrade-drain-timeout for the running jobs to finish.
+
+        On SIGQUIT its main process stops requesting jobs and exits once its running jobs are done. The
+        service is stopped afterwards, so systemd does not restart it before the upgrade. Returns whether
+        every job finished.
+        """
+        pid = self.runner_pid()
+        if not pid:
+            return True
+        # Only the main process is signalled, the job stage processes in the service's cgroup die on SIGQUIT.
+        os.kill(pid, signal.SIGQUIT)
+        deadline = time.monotonic() + self.charm_config["upgrade-drain-timeout"] * 60
+        finished = True
+        while os.path.exists(os.path.join(self.proc_dir, str(pid))):
+            active = self.active_jobs()
+            if time.monotonic() >= deadline:
+                hookenv.log("{} jobs still running after the drain timeout".format(active), hookenv.WARNING)
+                finished = False
+                break
+            hookenv.status_set("maintenance", "Draining {} running jobs".format(active))
+            time.sleep(self.drain_poll_interval)
+        service("stop", "gitlab-runner")
+        return finished
 
     def upgrade(self):
-        """Install or upgrade the GitLab runner packages, adding APT sources as needed."""
+        """Install or upgrade the GitLab runner packages, adding APT sources as needed.
+
+        When a newer package is available for registered runners, it is downloaded while jobs still
+        run, then GitLab Runner is stopped gracefully so the upgrade does not interrupt jobs.
+        """
         self.add_sources()
-        apt_update()
-        apt_install("gitlab-runner")
-        self.set_global_config()
+        if self.apt_index_fresh():
+            hookenv.log("Skipping apt update, the package index is fresh")
+        else:
+            apt_update()
+        installed, candidate = self.package_versions("gitlab-runner")
+        registered = bool(RunnerConfig(self.runner_cfg_file).runners)
+        if installed and installed == candidate:
+            hookenv.log("gitlab-runner {} is up to date".format(installed))
+        elif installed and registered:
+            hookenv.status_set("maintenance", "Downloading gitlab-runner")
+            apt_install("gitlab-runner", options=["--download-only"])
+            hookenv.status_set("maintenance", "Draining jobs")
+            self.drain()
+        try:
+            hookenv.status_set("maintenance", "Upgrading gitlab-runner")
+            apt_install("gitlab-runner")
+        finally:
+            self.set_global_config()
         service("enable", "gitlab-runner")
         service("start", "gitlab-runner")
+        if registered and self.runners():
+            self.set_registered_status()
         return True
 
-    def configure(self):
-        """Register GitLab Runner and perform configuration changes when charm configuration is modified."""
-        self.set_global_config()
-        return True
+    def executor_context(self):
+        """Return the template context used to render the LXD executor scripts."""
+        return {
+            "executor_dir": self.executor_dir,
+            "state_dir": self.state_dir,
+            "gitlab_user": self.gitlab_user,
+            "images": self.charm_config["lxd-images"].split(),
+            "warm_pool_size": self.charm_config["lxd-warm-pool-size"],
+            "tools_version": self.charm_config["lxd-tools-version"],
+            "clone_containers": self.charm_config["lxd-clone-containers"],
+            "boot_timeout": self.charm_config["lxd-boot-timeout"],
+            "cache_volumes": self.charm_config["lxd-cache-volumes"],
+            "cache_volume_size": self.charm_config["lxd-cache-volume-size"],
+            "cache_evict_threshold": self.charm_config["lxd-cache-evict-threshold"],
+            "persist_builds": self.charm_config["lxd-persist-builds"],
+            "cleanup_workers": self.charm_config["lxd-cleanup-workers"],
+            "recycle_containers": self.charm_config["lxd-recycle-containers"],
+            "cpu_limit": self.charm_config["lxd-cpu-limit"],
+            "cpu_limit_max": self.charm_config["lxd-cpu-limit-max"],
+            "memory_limit_max": self.charm_config["lxd-memory-limit-max"],
+            "cpu_pinning": self.charm_config["lxd-cpu-pinning"],
+            "builds_tmpfs_size": self.charm_config["lxd-builds-tmpfs-size"],
+            "tmp_tmpfs_size": self.charm_config["lxd-tmp-tmpfs-size"],
+            "builds_storage_pool": self.charm_config["lxd-builds-storage-pool"],
+            "prebuilt_images": self.charm_config["lxd-prebuilt-images"],
+            "docker_hot_images": self.docker_hot_images(),
+            "image_refresh_interval": self.charm_config["image-refresh-interval"],
+            "image_prune_watermark": self.charm_config["image-prune-watermark"],
+            "reaper_max_age": self.charm_config["lxd-reaper-max-age"],
+            "reaper_batch_size": self.charm_config["lxd-reaper-batch-size"],
+            "local_cache": self.charm_config["local-cache"],
+            "metrics": bool(self.charm_config["executor-metrics-listen-address"]),
+            "metrics_listen_address": self.charm_config["executor-metrics-listen-address"],
+            "driver": self.charm_config["lxd-executor-driver"],
+            "output_limit": self.charm_config["output-limit"],
+            "runner_cfg_file": self.runner_cfg_file,
+            "concurrency": self.charm_config["concurrency"],
+            "concurrency_bounds": self.autoscaler_bounds(),
+            "runner_limits": {name: settings["limit"] for name, settings in self.runner_settings().items()},
+        }
 
-    def setup_lxd(self):
-        """Set up custom LXD executor scripts."""
-        templating.render(
-            "base.j2",
-            self.executor_dir + "/base.sh",
-            context="",
-            owner=self.gitlab_user,
-            group=self.gitlab_user,
-            perms=0o775,
-        )
-        templating.render(
-            "prepare.j2",
-            self.executor_dir + "/prepare.sh",
-            context="",
-            owner=self.gitlab_user,
-            group=self.gitlab_user,
-            perms=0o775,
-        )
-        templating.render(
-            "run.j2",
-            self.executor_dir + "/run.sh",
-            context="",
+    def install_helper(self, name):
+        """Copy a standalone Python helper from the charm's lib directory to the executor directory.
+
+        Returns whether the installed copy changed.
+        """
+        path = "{}/{}".format(self.executor_dir, name)
+        installed = self.read_file(path)
+        with open(os.path.join(hookenv.charm_dir(), "lib", name), "rb") as helper:
+            content = helper.read()
+        write_file(path, content, owner=self.gitlab_user, group=self.gitlab_user, perms=0o755)
+        return installed != content
+
+    def read_file(self, path):
+        """Return the contents of a file as bytes, or None if it does not exist."""
+        try:
+            with open(path, "rb") as existing:
+                return existing.read()
+        except FileNotFoundError:
+            return None
+
+    def render_executor(self):
+        """Render the custom LXD executor scripts from the charm configuration."""
+        context = self.executor_context()
+        for script in ["base", "prepare", "run", "cleanup", "pool", "build-image", "reap", "dispose", "images"]:
+            template = "{}.j2".format(script)
+            if context["driver"] == "python" and script in ["prepare", "run", "cleanup"]:
+                # The stages are run by lxdexecutor.py, talking to the LXD API directly.
+                template = "driver.j2"
+            templating.render(
+                template,
+                "{}/{}.sh".format(self.executor_dir, script),
+                context=dict(context, stage=script),
+                owner=self.gitlab_user,
+                group=self.gitlab_user,
+                perms=0o775,
+            )
+        subdirs = ["jobs", "pool", "volumes", "metrics", "dispose", "images"]
+        for path in [self.state_dir] + [self.state_dir + "/" + d for d in subdirs]:
+            mkdir(path, owner=self.gitlab_user, group=self.gitlab_user, perms=0o775)
+        write_file(
+            self.executor_dir + "/executor.json",
+            json.dumps(context, indent=2, sort_keys=True, default=str).encode(),
             owner=self.gitlab_user,
             group=self.gitlab_user,
-            perms=0o775,
+            perms=0o644,
         )
+        self.install_helper("lxdexecutor.py")
+
+    def render_unit(self, name):
+        """Render a systemd unit of the LXD executor, returning whether the unit file changed."""
+        path = "{}/{}".format(self.systemd_dir, name)
+        rendered = self.read_file(path)
         templating.render(
-            "cleanup.j2",
-            self.executor_dir + "/cleanup.sh",
-            context="",
-            owner=self.gitlab_user,
-            group=self.gitlab_user,
-            perms=0o775,
+            "{}.j2".format(name),
+            path,
+            context=self.executor_context(),
+            perms=0o644,
         )
+        return self.read_file(path) != rendered
+
+    def configure_unit(self, name, enabled):
+        """Render a systemd unit of the LXD executor, then (re)start it if enabled or stop it otherwise."""
+        self.render_unit(name)
+        subprocess.check_call(["systemctl", "daemon-reload"], stderr=subprocess.STDOUT)
+        if enabled:
+            service("enable", name)
+            service("restart", name)
+        else:
+            service("stop", name)
+            service("disable", name)
+
+    def configure_warm_pool(self):
+        """Start the warm pool daemon, or stop it and drain the pool when it is disabled."""
+        pool_size = self.charm_config["lxd-warm-pool-size"]
+        self.configure_unit("lxd-executor-pool.service", pool_size > 0)
+        if pool_size > 0:
+            hookenv.log("Keeping {} warm LXD containers per image".format(pool_size))
+        else:
+            subprocess.check_call(
+                [self.executor_dir + "/pool.sh", "drain"], stderr=subprocess.STDOUT
+            )
+
+    def configure_autoscaler(self):
+        """Install and run the concurrency autoscaler when concurrency-max is set, or stop it.
+
+        Nothing is done when neither the autoscaler nor its settings changed.
+        """
+        # Runner options are configured on install, possibly before the LXD executor is set up.
+        mkdir(self.executor_dir, owner=self.gitlab_user, group=self.gitlab_user, perms=0o775)
+        enabled = bool(self.autoscaler_bounds())
+        changed = self.install_helper("runnerautoscaler.py")
+        changed = self.render_unit("gitlab-runner-autoscaler.service") or changed
+        # A restart resets the autoscaler's hysteresis, so it only restarts when what it runs changed.
+        if not changed and self.kv.get("autoscaler_enabled") == enabled:
+            return
+        self.configure_unit("gitlab-runner-autoscaler.service", enabled)
+        self.kv.set("autoscaler_enabled", enabled)
+
+    def configure_metrics(self):
+        """Install and run the exporter of the LXD executor job phase metrics when enabled."""
+        self.install_helper("lxdmetrics.py")
+        self.configure_unit("lxd-executor-exporter.service", bool(self.charm_config["executor-metrics-listen-address"]))
+
+    def docker_hot_images(self):
+        """Return the Docker images jobs are known to use, the default image first."""
+        images = [self.charm_config["docker-image"]]
+        for image in self.charm_config["docker-hot-images"].split():
+            if image not in images:
+                images.append(image)
+        return images
+
+    def configure_image_refresh(self):
+        """Refresh and prune job images periodically, unless the refresh interval is 0."""
+        self.render_unit("gitlab-runner-images.service")
+        self.configure_unit("gitlab-runner-images.timer", self.charm_config["image-refresh-interval"] > 0)
+
+    def configure_reaper(self):
+        """Run the reaper of left over job containers periodically."""
+        self.render_unit("lxd-executor-reaper.service")
+        self.configure_unit("lxd-executor-reaper.timer", True)
+
+    def lxd_image_fingerprint(self, image):
+        """Return the fingerprint of an LXD image or alias, or None if it does not exist."""
+        try:
+            output = subprocess.check_output(
+                ["lxc", "image", "info", image], stderr=subprocess.DEVNULL
+            ).decode()
+        except subprocess.CalledProcessError:
+            return None
+        for line in output.splitlines():
+            if line.startswith("Fingerprint:"):
+                return line.split(":", 1)[1].strip()
+        return None
+
+    def build_images(self, force=False):
+        """Pre-build an image with the job dependencies for each image in lxd-images.
+
+        An image is only rebuilt when its upstream fingerprint, the local cache or the tools version
+        changes, or when forced. What an image was built from is recorded by build-image.sh, which
+        images.sh also runs. Returns a dict of image name to the local alias built from it.
+        """
+        tools_version = self.charm_config["lxd-tools-version"]
+        results = {}
+        for image in self.charm_config["lxd-images"].split():
+            key = re.sub("[^a-zA-Z0-9]", "-", image)
+            alias = "gitlab-runner-{}-{}".format(key, tools_version)
+            inputs = "{} {}".format(
+                self.lxd_image_fingerprint(image), "true" if self.charm_config["local-cache"] else "false"
+            )
+            try:
+                with open(os.path.join(self.state_dir, "images", key), "r") as record:
+                    built = record.read().strip()
+            except FileNotFoundError:
+                built = None
+            if not force and built == inputs and self.lxd_image_fingerprint(alias):
+                hookenv.log("Pre-built image {} is up to date".format(alias))
+            else:
+                hookenv.log("Building {} from {}".format(alias, image))
+                subprocess.check_call(
+                    [self.executor_dir + "/build-image.sh", image] + (["--force"] if force else []),
+                    stderr=subprocess.STDOUT,
+                )
+            results[image] = alias
+        return results
+
+    def lxd_host_settings(self):
+        """Return the settings of the gitlab LXD profile and lxdbr0 network that jobs rely on.
+
+        The profile holds the default resource limits of every job, settings that are None are
+        removed from it.
+        """
+        disk_limit = self.charm_config["lxd-disk-io-limit"]
+        return {
+            "profile": {
+                "security.nesting": "true",
+                "security.privileged": "true",
+                "raw.lxc": "lxc.apparmor.profile=unconfined\nlxc.mount.auto=sys:rw\n",
+                "limits.cpu": self.charm_config["lxd-cpu-limit"] or None,
+                "limits.memory": self.charm_config["lxd-memory-limit"] or None,
+                "limits.processes": str(self.charm_config["lxd-processes-limit"] or "") or None,
+            },
+            # The gitlab profile is applied after the default one, so its root disk replaces the default one.
+            "root_disk": {"limits.max": disk_limit} if disk_limit else None,
+            # prevent name collisions when using nested LXD on .lxd
+            "network": {"dns.domain": "juju-gitlab-runner"},
+        }
+
+    def configure_lxd_host(self, force=False):
+        """Apply the LXD profile and network settings when they changed since they were last applied.
+
+        These are global writes to the LXD database, which jobs starting at the same time would
+        serialize on, so jobs only check the profile exists. Returns whether they were applied.
+        """
+        settings = self.lxd_host_settings()
+        digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        if not force and self.kv.get("lxd_host_settings") == digest:
+            return False
+        try:
+            subprocess.check_output(["lxc", "profile", "show", "gitlab"], stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            subprocess.check_call(["lxc", "profile", "create", "gitlab"], stderr=subprocess.STDOUT)
+        for key, value in sorted(settings["profile"].items()):
+            if value is None:
+                subprocess.check_call(["lxc", "profile", "unset", "gitlab", key], stderr=subprocess.STDOUT)
+            else:
+                subprocess.check_call(["lxc", "profile", "set", "gitlab", key, value], stderr=subprocess.STDOUT)
+        self.configure_profile_root_disk(settings["root_disk"])
+        for key, value in sorted(settings["network"].items()):
+            subprocess.check_call(["lxc", "network", "set", "lxdbr0", key, value], stderr=subprocess.STDOUT)
+        self.kv.set("lxd_host_settings", digest)
+        return True
+
+    def configure_profile_root_disk(self, limits):
+        """Add a root disk with limits to the gitlab profile, or remove it when limits is None."""
+        devices = subprocess.check_output(["lxc", "profile", "device", "list", "gitlab"]).decode().split()
+        if limits and "root" in devices:
+            for key, value in sorted(limits.items()):
+                subprocess.check_call(
+                    ["lxc", "profile", "device", "set", "gitlab", "root", key, value], stderr=subprocess.STDOUT
+                )
+        elif limits:
+            subprocess.check_call(
+                ["lxc", "profile", "device", "add", "gitlab", "root", "disk", "path=/", "pool=default"]
+                + ["{}={}".format(key, value) for key, value in sorted(limits.items())],
+                stderr=subprocess.STDOUT,
+            )
+        elif "root" in devices:
+            subprocess.check_call(["lxc", "profile", "device", "remove", "gitlab", "root"], stderr=subprocess.STDOUT)
+
+    def configure_lxd(self):
+        """Apply charm configuration changes to the LXD executor."""
+        self.configure_lxd_storage()
+        self.configure_lxd_host()
+        self.render_executor()
+        if self.charm_config["lxd-prebuilt-images"]:
+            self.build_images()
+        self.configure_warm_pool()
+        self.configure_unit("lxd-executor-dispose.service", True)
+        self.configure_reaper()
+        self.configure_image_refresh()
+        self.configure_metrics()
+
+    def lxd_storage_settings(self):
+        """Return the settings of the default LXD storage pool from the charm configuration."""
+        return {
+            "backend": self.charm_config["lxd-storage-backend"],
+            "device": self.charm_config["lxd-storage-device"],
+            "size": self.charm_config["lxd-storage-size"],
+            "zfs_compression": self.charm_config["lxd-storage-zfs-compression"],
+        }
+
+    def lxd_preseed(self, settings):
+        """Return the lxd init preseed creating the default storage pool, network and profile."""
+        backend = settings["backend"]
+        driver = "lvm" if backend == "lvm-thin" else backend
+        config = {}
+        if settings["device"]:
+            config["source"] = settings["device"]
+        elif settings["size"] and driver != "dir":
+            config["size"] = settings["size"]
+        if driver == "lvm":
+            config["lvm.use_thinpool"] = "true" if backend == "lvm-thin" else "false"
+        return {
+            "storage_pools": [{"name": "default", "driver": driver, "config": config}],
+            "networks": [{
+                "name": "lxdbr0",
+                "type": "bridge",
+                "config": {"ipv4.address": "auto", "ipv6.address": "auto"},
+            }],
+            "profiles": [{
+                "name": "default",
+                "devices": {
+                    "root": {"type": "disk", "path": "/", "pool": "default"},
+                    "eth0": {"type": "nic", "name": "eth0", "network": "lxdbr0"},
+                },
+            }],
+        }
+
+    def lxd_storage_driver(self):
+        """Return the driver of LXD's default storage pool, such as zfs or lvm, or None if there is no such pool."""
+        try:
+            output = subprocess.check_output(
+                ["lxc", "storage", "show", "default"], stderr=subprocess.DEVNULL
+            ).decode()
+            pool = yaml.safe_load(output)
+        except (OSError, subprocess.CalledProcessError, yaml.YAMLError):
+            return None
+        return pool.get("driver") if isinstance(pool, dict) else None
+
+    def configure_lxd_storage(self):
+        """Initialise LXD with the configured storage pool, or tune the pool it already has.
+
+        An existing pool is never initialised again, as that would destroy the containers and
+        images on it, so changing its backend, device or size needs a new unit. Tunables such as
+        ZFS compression only apply to a pool with that driver. Returns whether anything was applied.
+        """
+        settings = self.lxd_storage_settings()
+        applied = self.kv.get("lxd_storage")
+        if applied == settings:
+            return False
+        backend = settings["backend"]
+        driver = self.kv.get("lxd_storage_driver") or self.lxd_storage_driver()
+        if applied is None and driver is None:
+            if backend:
+                apt_install(self.storage_packages.get(backend, []))
+                hookenv.log("Initialising LXD with a {} storage pool".format(backend))
+                # lxd init reads its preseed as YAML, of which JSON is a subset.
+                subprocess.check_output(
+                    ["lxd", "init", "--preseed"],
+                    input=json.dumps(self.lxd_preseed(settings)).encode(),
+                    stderr=subprocess.STDOUT,
+                )
+            else:
+                subprocess.check_call(["lxd", "init", "--auto"], stderr=subprocess.STDOUT)
+            driver = self.lxd_storage_driver()
+        elif applied is None:
+            # A unit set up before the storage settings were recorded, its pool is kept as it is.
+            hookenv.log("Keeping the existing {} LXD storage pool".format(driver))
+        elif any(applied.get(key) != settings[key] for key in ["backend", "device", "size"]):
+            hookenv.log(
+                "The LXD storage pool already exists, lxd-storage-backend, lxd-storage-device and "
+                "lxd-storage-size only apply to new units",
+                hookenv.WARNING,
+            )
+        if driver == "zfs" and settings["zfs_compression"]:
+            subprocess.check_call(
+                ["zfs", "set", "compression={}".format(settings["zfs_compression"]), "default"],
+                stderr=subprocess.STDOUT,
+            )
+        self.kv.set("lxd_storage", settings)
+        if driver:
+            self.kv.set("lxd_storage_driver", driver)
+        return True
+
+    def setup_lxd(self):
+        """Prepare the host for the LXD executor, the executor itself is configured by configure_lxd."""
         add_user_to_group(self.gitlab_user, "lxd")
-        command = [
-            "lxd",
-            "init",
-            "--auto",
-        ]
-        subprocess.check_call(command, stderr=subprocess.STDOUT)
+        if self.charm_config["lxd-clone-containers"] and \
+                self.charm_config["lxd-storage-backend"] not in ["zfs", "btrfs", "lvm-thin"]:
+            hookenv.log(
+                "lxd-clone-containers needs a zfs, btrfs or lvm-thin lxd-storage-backend to clone containers "
+                "copy-on-write",
+                hookenv.WARNING,
+            )
+        self.configure_lxd_storage()
+        self.configure_lxd_host(force=True)
 
-    def set_global_config(self):
-        """Set the concurrency value."""
-        for line in fileinput.input(self.runner_cfg_file, inplace=True):
-            if line.startswith("concurrent"):
-                print("concurrent = {}".format(self.charm_config["concurrency"]))
-            elif line.startswith("check_interval"):
-                print("check_interval = {}".format(self.charm_config["check-interval"]))
+    def host_job_capacity(self):
+        """Return how many jobs the host has CPUs and memory for, allowing one CPU and job_memory_gib per job."""
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemTotal:"):
+                    memory_gib = int(line.split()[1]) // (1024 * 1024)
+                    break
+        return max(1, min(os.cpu_count(), memory_gib // self.job_memory_gib))
+
+    def runner_limits(self):
+        """Return the job limit of each executor, sharing the host capacity between those set to auto."""
+        limits = {}
+        auto = []
+        for executor in ["docker", "lxd"]:
+            limit = str(self.charm_config["{}-limit".format(executor)]).strip().lower()
+            if limit == "auto":
+                auto.append(executor)
+            elif limit.isdigit():
+                limits[executor] = int(limit)
             else:
-                print(line, end="")
+                hookenv.log(
+                    "Ignoring {}-limit {!r}, it is not a number or auto".format(executor, limit), hookenv.ERROR
+                )
+                limits[executor] = 0
+        if auto:
+            remaining = self.host_job_capacity() - sum(limits.values())
+            for executor in auto:
+                limits[executor] = max(1, remaining // len(auto))
+        return limits
+
+    def runner_settings(self):
+        """Return the per-runner settings of each runner this unit provides, by runner name."""
+        limits = {"{}-{}".format(self.hostname, executor): limit for executor, limit in self.runner_limits().items()}
+        for name, runner in self.extra_runners().items():
+            limits[name] = runner["limit"]
+        settings = {}
+        for name, limit in limits.items():
+            settings[name] = {
+                "limit": limit,
+                "request_concurrency": self.charm_config["request-concurrency"],
+                "output_limit": self.charm_config["output-limit"],
+            }
+        return settings
+
+    def docker_settings(self):
+        """Return the [runners.docker] settings of the Docker runner, None values are removed."""
+        return {
+            "image": self.charm_config["docker-image"],
+            "pull_policy": self.charm_config["docker-pull-policy"],
+            "volumes": self.charm_config["docker-volumes"].split(),
+            "shm_size": self.charm_config["docker-shm-size"] or None,
+        }
+
+    def autoscaler_bounds(self):
+        """Return the concurrency range the autoscaler keeps to, or None when autoscaling is disabled."""
+        if self.charm_config["concurrency-max"] <= 0:
+            return None
+        minimum = max(1, self.charm_config["concurrency-min"])
+        return minimum, max(minimum, self.charm_config["concurrency-max"])
 
-    def unregister(self):
-        """Unregister all runners."""
+    def concurrency(self, config):
+        """Return the concurrent setting for a RunnerConfig, keeping the autoscaled value within its bounds."""
+        concurrency = self.charm_config["concurrency"]
+        bounds = self.autoscaler_bounds()
+        if not bounds:
+            return concurrency
+        current = config.data.get("concurrent", concurrency)
+        return min(max(current, bounds[0]), bounds[1])
+
+    def apply_runner_settings(self, config):
+        """Apply the per-runner settings to the runners present in a RunnerConfig.
+
+        While autoscaling, the job limits are scaled from the concurrency option to the current concurrency.
+        """
+        concurrent = config.data.get("concurrent", self.charm_config["concurrency"])
+        for name, settings in self.runner_settings().items():
+            if self.autoscaler_bounds():
+                settings["limit"] = scaled_limit(settings["limit"], self.charm_config["concurrency"], concurrent)
+            for key, value in settings.items():
+                config.set_runner(name, key, value)
+        docker_runners = ["{}-docker".format(self.hostname)]
+        docker_runners.extend(name for name, runner in self.extra_runners().items() if runner["executor"] == "docker")
+        for name in docker_runners:
+            for key, value in self.docker_settings().items():
+                config.set_runner(name, key, value, section="docker")
+
+    def set_global_config(self):
+        """Set the global and per-runner settings, writing config.toml only when they changed."""
+        with config_lock(self.runner_cfg_file):
+            config = RunnerConfig(self.runner_cfg_file)
+            config.set_global("concurrent", self.concurrency(config))
+            config.set_global("check_interval", self.charm_config["check-interval"])
+            config.set_global("listen_address", self.charm_config["metrics-listen-address"] or None)
+            self.apply_runner_settings(config)
+            saved = config.save()
+        if saved:
+            hookenv.log("Updated GitLab Runner configuration {}".format(self.runner_cfg_file))
+        return saved
+
+    def unregister(self, name=None):
+        """Unregister the named runner, or all runners."""
         command = [
             "/usr/bin/gitlab-runner",
             "unregister",
-            "--all-runners",
         ]
-        subprocess.check_call(command, stderr=subprocess.STDOUT)
+        registered = self.kv.get("registered_runners", {})
+        if name:
+            command.extend(["--name", name])
+            registered.pop(name, None)
+        else:
+            command.append("--all-runners")
+            registered = {}
+        with config_lock(self.runner_cfg_file):
+            subprocess.check_call(command, stderr=subprocess.STDOUT)
+        self.kv.set("registered_runners", registered)
@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+"""GitLab Runner custom executor driver for LXD, using the LXD REST API.
+
+Implements the prepare, run and cleanup stages over a persistent connection to the LXD unix
+socket instead of running the lxc client many times per job. Commands run in the container
+through the exec API, with their output streamed over websockets.
+
+The driver reads its settings from executor.json, rendered by the charm next to this file, and
+shares its state directory layout with the shell executor in base.sh. Slow paths that are not
+run for every job, such as creating golden snapshots and installing job dependencies, are left
+to the functions in base.sh. This module only uses the standard library, as it runs outside of
+the charm's virtualenv.
+"""
+import base64
+import http.client
+import json
+import os
+import re
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+EXECUTOR_DIR = os.path.dirname(os.path.abspath(__file__))
+LXD_SOCKETS = ["/var/snap/lxd/common/lxd/unix.socket", "/var/lib/lxd/unix.socket"]
+# The default remotes of the lxc client.
+REMOTES = {
+    "images": "https://images.linuxcontainers.org",
+    "ubuntu": "https://cloud-images.ubuntu.com/releases",
+    "ubuntu-daily": "https://cloud-images.ubuntu.com/daily",
+}
+DEFAULT_IMAGE = "ubuntu:18.04"
+# The gitlab profile comes last, so its root disk limits win over the default profile.
+PROFILES = ["default", "gitlab"]
+STORAGE_POOL = "default"
+API_RETRIES = 3
+
+# Runs inside the container, and returns as soon as systemd reports the boot has finished.
+READY_CHECK = """
+command -v systemctl >/dev/null || exit 0
+i=0
+while [ $i -lt {polls} ]; do
+    case "$(systemctl is-system-running 2>/dev/null)" in
+        running|degraded) exit 0 ;;
+        maintenance|stopping) exit 1 ;;
+    esac
+    sleep 0.05
+    i=$((i + 1))
+done
+exit 1
+"""
+
+SIZE_UNITS = {
+    "": 1, "B": 1, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3, "TB": 1000 ** 4,
+    "KiB": 1024, "MiB": 1024 ** 2, "GiB": 1024 ** 3, "TiB": 1024 ** 4,
+}
+
+# Job output is written out in chunks of up to LOG_CHUNK bytes, at least every LOG_FLUSH_INTERVAL
+# seconds, and writers block once LOG_BUFFER bytes are waiting to be written.
+LOG_CHUNK = 64 * 1024
+LOG_BUFFER = 4 * LOG_CHUNK
+LOG_FLUSH_INTERVAL = 0.2
+
+WS_CONTINUATION, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+class LXDError(Exception):
+    """An LXD API request or operation failed."""
+
+
+def size_bytes(size):
+    """Convert an LXD size such as 4GB or 512MiB to bytes, 0 if it is invalid."""
+    match = re.match(r"^([0-9]+(?:\.[0-9]+)?)(.*)$", size)
+    if not match or match.group(2) not in SIZE_UNITS:
+        return 0
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def memory_available():
+    """Return the bytes of memory the host can hand out without swapping."""
+    with open("/proc/meminfo", "r") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def image_key(image):
+    """Turn an image name such as ubuntu:18.04 into something usable in container names and paths."""
+    return re.sub("[^a-zA-Z0-9]", "-", image)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path):
+        """Connect to the unix socket at socket_path."""
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        """Open the unix socket."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class WebSocket:
+    """Minimal RFC 6455 websocket client, enough for the LXD exec streams."""
+
+    def __init__(self, sock, buffered=b""):
+        """Wrap a socket on which the websocket handshake has completed."""
+        self.sock = sock
+        self.buffer = bytearray(buffered)
+        self.send_lock = threading.Lock()
+
+    @classmethod
+    def connect(cls, socket_path, path):
+        """Open a websocket to path on the LXD unix socket."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall(
+            "GET {} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n".format(path, key).encode()
+        )
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise LXDError("Websocket handshake for {} failed".format(path))
+            response += data
+        headers, _, rest = response.partition(b"\r\n\r\n")
+        if b" 101 " not in headers.split(b"\r\n", 1)[0]:
+            raise LXDError("Websocket handshake for {} failed: {}".format(path, headers.decode(errors="replace")))
+        return cls(sock, rest)
+
+    @staticmethod
+    def _mask(data, key):
+        if not data:
+            return data
+        length = len(data)
+        mask = (key * (length // 4 + 1))[:length]
+        return (int.from_bytes(data, "big") ^ int.from_bytes(mask, "big")).to_bytes(length, "big")
+
+    def _read_exact(self, length):
+        while len(self.buffer) < length:
+            data = self.sock.recv(max(65536, length - len(self.buffer)))
+            if not data:
+                raise EOFError()
+            self.buffer += data
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return data
+
+    def _read_frame(self):
+        first, second = self._read_exact(2)
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exact(8))[0]
+        key = self._read_exact(4) if second & 0x80 else None
+        payload = self._read_exact(length)
+        if key:
+            payload = self._mask(payload, key)
+        return bool(first & 0x80), first & 0x0F, payload
+
+    def send(self, data, opcode=WS_BINARY):
+        """Send one masked frame."""
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, length)
+        key = os.urandom(4)
+        with self.send_lock:
+            self.sock.sendall(header + key + self._mask(data, key))
+
+    def recv(self):
+        """Return the opcode and payload of the next message, WS_CLOSE once the stream has ended."""
+        message = bytearray()
+        message_opcode = None
+        while True:
+            try:
+                fin, opcode, payload = self._read_frame()
+            except (EOFError, OSError):
+                return WS_CLOSE, b""
+            if opcode == WS_PING:
+                self.send(payload, WS_PONG)
+            elif opcode == WS_CLOSE:
+                return WS_CLOSE, payload
+            elif opcode != WS_PONG:
+                if opcode != WS_CONTINUATION:
+                    message_opcode = opcode
+                message += payload
+                if fin:
+                    return message_opcode, bytes(message)
+
+    def close(self):
+        """Send a close frame and close the socket."""
+        try:
+            self.send(struct.pack("!H", 1000), WS_CLOSE)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class LXDClient:
+    """Client of the LXD REST API, keeping one connection open for all requests."""
+
+    def __init__(self, socket_path=None):
+        """Connect to the LXD unix socket, found from LXD_DIR or the snap and deb locations."""
+        if socket_path is None:
+            candidates = LXD_SOCKETS
+            if os.environ.get("LXD_DIR"):
+                candidates = [os.path.join(os.environ["LXD_DIR"], "unix.socket")]
+            socket_path = next((path for path in candidates if os.path.exists(path)), candidates[-1])
+        self.socket_path = socket_path
+        self.connection = UnixHTTPConnection(socket_path)
+
+    def request(self, method, path, body=None):
+        """Make an API request and return the decoded response.
+
+        GET and DELETE requests are retried on a dropped connection. Other requests may already have
+        been applied when the connection drops, so they are not.
+        """
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload else {}
+        attempts = API_RETRIES if method in ["GET", "DELETE"] else 1
+        for attempt in range(attempts):
+            try:
+                self.connection.request(method, path, body=payload, headers=headers)
+                response = json.loads(self.connection.getresponse().read().decode())
+                break
+            except (http.client.HTTPException, ConnectionError, BrokenPipeError):
+                self.connection.close()
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+        if response.get("type") == "error":
+            raise LXDError("{} {}: {}".format(method, path, response.get("error")))
+        return response
+
+    def exists(self, path):
+        """Return whether an API object exists."""
+        try:
+            self.request("GET", path)
+        except LXDError:
+            return False
+        return True
+
+    def wait(self, response, timeout=None):
+        """Wait for the operation started by an asynchronous request, and return its metadata."""
+        path = "{}/wait".format(response["operation"])
+        if timeout is not None:
+            path += "?timeout={}".format(int(timeout))
+        operation = self.request("GET", path)["metadata"]
+        if operation["status_code"] >= 400:
+            raise LXDError("Operation {} failed: {}".format(response["operation"], operation.get("err")))
+        return operation
+
+    def call(self, method, path, body=None, timeout=None):
+        """Make an API request, waiting for its operation if it is asynchronous."""
+        response = self.request(method, path, body)
+        if response.get("type") == "async":
+            return self.wait(response, timeout)
+        return response.get("metadata")
+
+    def set_state(self, name, action, force=False):
+        """Start or stop a container."""
+        self.call("PUT", "/1.0/containers/{}/state".format(name), {"action": action, "timeout": 30, "force": force})
+
+    def exec(self, name, command, stdin=None, stdout=None, stderr=None, environment=None):
+        """Run a command in a container and return its exit code.
+
+        stdin is a file object to read from, stdout and stderr are binary file objects the output
+        is streamed to as it arrives. Output is discarded when they are None.
+        """
+        response = self.request("POST", "/1.0/containers/{}/exec".format(name), {
+            "command": command,
+            "environment": environment or {},
+            "interactive": False,
+            "wait-for-websocket": True,
+        })
+        operation = response["operation"]
+        fds = response["metadata"]["metadata"]["fds"]
+
+        def websocket(fd):
+            return WebSocket.connect(
+                self.socket_path, "{}/websocket?secret={}".format(operation, quote(fds[fd]))
+            )
+
+        control = websocket("control")
+        streams = {fd: websocket(fd) for fd in ["0", "1", "2"]}
+        readers = [
+            threading.Thread(target=self._receive, args=(streams["1"], stdout)),
+            threading.Thread(target=self._receive, args=(streams["2"], stderr)),
+        ]
+        for reader in readers:
+            reader.start()
+        self._send(streams["0"], stdin)
+        for reader in readers:
+            reader.join()
+        for stream in list(streams.values()) + [control]:
+            stream.close()
+        return self.wait(response)["metadata"]["return"]
+
+    @staticmethod
+    def _send(stream, source):
+        while source is not None:
+            data = source.read(65536)
+            if not data:
+                break
+            stream.send(data)
+        # An empty text message marks the end of stdin.
+        stream.send(b"", WS_TEXT)
+
+    @staticmethod
+    def _receive(stream, sink):
+        while True:
+            opcode, data = stream.recv()
+            if opcode != WS_BINARY:
+                break
+            if sink is not None:
+                sink.write(data)
+                sink.flush()
+
+
+class LogPipe:
+    """Stream job output to a sink through a bounded buffer, coalescing small writes and capping its size.
+
+    A writer thread empties the buffer into the sink, so a slow sink makes writers wait instead of
+    the buffer growing. Output past limit bytes is counted but discarded after a notice.
+    """
+
+    def __init__(self, sink, limit=0):
+        """Stream to the binary file object sink, keeping at most limit bytes, 0 for no limit."""
+        self.sink = sink
+        self.limit = limit
+        self.buffer = bytearray()
+        self.accepted = 0
+        self.bytes = 0
+        self.lines = 0
+        self.truncated = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self._write_out, daemon=True)
+        self.writer.start()
+
+    def write(self, data):
+        """Queue output for the sink, waiting while the buffer is full."""
+        with self.condition:
+            self.bytes += len(data)
+            self.lines += data.count(b"\n")
+            if self.truncated or self.closed:
+                return
+            if self.limit and self.accepted + len(data) > self.limit:
+                data = data[:self.limit - self.accepted] + (
+                    "\nJob output exceeded the limit of {} bytes, the rest of it is not shown.\n"
+                    .format(self.limit).encode())
+                self.truncated = True
+            while len(self.buffer) >= LOG_BUFFER and not self.closed:
+                self.condition.wait()
+            if not self.buffer or len(self.buffer) + len(data) >= LOG_CHUNK:
+                self.condition.notify_all()
+            self.buffer.extend(data)
+            self.accepted += len(data)
+
+    def flush(self):
+        """Do nothing, the writer thread flushes coalesced output."""
+
+    def close(self):
+        """Write out the remaining output and stop the writer thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+
+    def _write_out(self):
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if len(self.buffer) < LOG_CHUNK and not self.closed:
+                    # Let small writes accumulate, unless the buffer fills up first.
+                    self.condition.wait(LOG_FLUSH_INTERVAL)
+                data, self.buffer = bytes(self.buffer), bytearray()
+                done = self.closed
+                self.condition.notify_all()
+            try:
+                if data:
+                    self.sink.write(data)
+                    self.sink.flush()
+            except OSError:
+                # Nobody reads the output any more, discard the rest instead of blocking the job.
+                done = True
+                with self.condition:
+                    self.closed = True
+                    self.buffer = bytearray()
+                    self.condition.notify_all()
+            if done:
+                return
+
+
+class Executor:
+    """The prepare, run and cleanup stages of the LXD executor for one job."""
+
+    def __init__(self, config, client, environ=None):
+        """Set up the stages of the job described by the CUSTOM_ENV_ variables in environ."""
+        self.config = config
+        self.client = client
+        self.environ = os.environ if environ is None else environ
+        self.state_dir = config["state_dir"]
+        # Unique per job, containers left behind are deleted by reap.sh.
+        self.job_name = "runner-{}-project-{}-concurrent-{}-{}".format(
+            self.environ.get("CUSTOM_ENV_CI_RUNNER_ID", ""),
+            self.environ.get("CUSTOM_ENV_CI_PROJECT_ID", ""),
+            self.environ.get("CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID", ""),
+            self.environ.get("CUSTOM_ENV_CI_JOB_ID", ""),
+        )
+        self.image = self.environ.get("CUSTOM_ENV_CI_JOB_IMAGE") or DEFAULT_IMAGE
+        self.project = self.environ.get("CUSTOM_ENV_CI_PROJECT_ID") or "none"
+        # Prepare records the container of each running job here. A container claimed from the warm
+        # pool keeps its pool name.
+        self.job_file = os.path.join(self.state_dir, "jobs", self.job_name)
+        self.container = self.job_name
+        if os.path.exists(self.job_file):
+            with open(self.job_file, "r") as job_file:
+                self.container = job_file.read().strip()
+
+    def record_metric(self, name, value, **labels):
+        """Append a sample for the executor metrics exporter, lxdmetrics.py."""
+        if not self.config["metrics"]:
+            return
+        line = " ".join([name, str(value)] + ["{}={}".format(key, label) for key, label in sorted(labels.items())])
+        with open(os.path.join(self.state_dir, "metrics", "samples.log"), "a") as samples:
+            samples.write(line + "\n")
+
+    def record_timing(self, phase, start):
+        """Record how long a phase of the job took."""
+        self.record_metric(
+            "phase_duration_seconds", "{:.3f}".format(time.time() - start),
+            phase=phase, image=self.image, project=self.project,
+        )
+
+    def shell(self, function, *args, background=False):
+        """Run one of the base.sh functions, for the slow paths shared with the shell executor."""
+        command = ["bash", "-c", 'source "$0"; "$@"', os.path.join(EXECUTOR_DIR, "base.sh"), function] + list(args)
+        if background:
+            subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            return 0
+        return subprocess.call(command, stdout=sys.stdout, stderr=sys.stderr)
+
+    def log(self, message):
+        """Print a message to the job log."""
+        print(message, flush=True)
+
+    def exists(self, name):
+        """Return whether a container exists."""
+        return self.client.exists("/1.0/containers/{}".format(name))
+
+    def delete(self, name):
+        """Force stop and delete a container."""
+        state = self.client.call("GET", "/1.0/containers/{}/state".format(name))
+        if state["status"] != "Stopped":
+            self.client.set_state(name, "stop", force=True)
+        self.client.call("DELETE", "/1.0/containers/{}".format(name))
+
+    def verify_profile(self):
+        """Make sure the gitlab profile exists. The charm creates and configures it."""
+        if not self.client.exists("/1.0/profiles/gitlab"):
+            raise LXDError("The gitlab LXD profile is missing, it is created by the charm when LXD is set up")
+
+    def remove_old_container(self):
+        """Delete the container of a previous attempt of this job, so its name can be reused."""
+        if os.path.exists(self.job_file):
+            self.log("Found container of a previous attempt of this job, deleting")
+            if self.exists(self.container):
+                self.delete(self.container)
+            self.remove_scratch()
+            os.remove(self.job_file)
+            self.container = self.job_name
+
+    def claim_pool_container(self):
+        """Atomically take a ready container for the job image out of the warm pool.
+
+        The marker file is renamed to the job file, so only one job can win it.
+        """
+        pool_dir = os.path.join(self.state_dir, "pool", image_key(self.image))
+        try:
+            markers = [marker for marker in os.listdir(pool_dir) if not marker.startswith(".")]
+        except FileNotFoundError:
+            return None
+        for marker in markers:
+            try:
+                os.rename(os.path.join(pool_dir, marker), self.job_file)
+            except FileNotFoundError:
+                continue
+            # The marker's age is the time it spent in the pool, the job starts now.
+            os.utime(self.job_file)
+            with open(self.job_file, "r") as job_file:
+                return job_file.read().strip()
+        return None
+
+    def image_source(self, image):
+        """Return the container source of an image, which is either a local alias or on a remote."""
+        remote, sep, alias = image.partition(":")
+        if sep and remote in REMOTES:
+            return {"type": "image", "mode": "pull", "server": REMOTES[remote], "protocol": "simplestreams",
+                    "alias": alias}
+        return {"type": "image", "alias": image}
+
+    def launch(self, image, name):
+        """Create and start a container from an image."""
+        start = time.time()
+        self.client.call("POST", "/1.0/containers", {"name": name, "source": self.image_source(image),
+                                                     "profiles": PROFILES})
+        self.client.set_state(name, "start")
+        self.record_timing("launch", start)
+
+    def wait_ready(self, name):
+        """Wait for the container to finish booting, within the configured boot timeout."""
+        start = time.time()
+        while True:
+            # Each attempt polls for the time left, so a slow attempt cannot overshoot the boot timeout.
+            polls = max(1, int((self.config["boot_timeout"] - (time.time() - start)) * 20))
+            try:
+                ready = self.client.exec(name, ["sh", "-c", READY_CHECK.format(polls=polls)]) == 0
+            except LXDError:
+                ready = False
+            elapsed = time.time() - start
+            if ready:
+                # Boot times are always logged, the metrics only when the exporter is enabled.
+                with open(os.path.join(self.state_dir, "boot-times.log"), "a") as boot_times:
+                    boot_times.write("{} {} {:.3f}\n".format(int(time.time()), name, elapsed))
+                self.record_metric("phase_duration_seconds", "{:.3f}".format(elapsed), phase="boot",
+                                   image=self.image, project=self.project)
+                self.log("Container {} ready after {:.3f}s".format(name, elapsed))
+                return True
+            if elapsed >= self.config["boot_timeout"]:
+                self.log("Waited for {} seconds to start container, exiting..".format(self.config["boot_timeout"]))
+                return False
+            time.sleep(0.1)
+
+    def provision(self, name):
+        """Launch from the pre-built image when there is one, otherwise install the job dependencies."""
+        baked = "gitlab-runner-{}-{}".format(image_key(self.image), self.config["tools_version"])
+        if self.client.exists("/1.0/images/aliases/{}".format(quote(baked, safe=""))):
+            self.record_metric("image_cache_hits_total", 1, image=self.image)
+            self.launch(baked, name)
+            return self.wait_ready(name)
+        # The image may have to be downloaded, and the dependencies installed.
+        self.record_metric("image_cache_misses_total", 1, image=self.image)
+        self.launch(self.image, name)
+        return self.wait_ready(name) and self.shell("install_dependencies", name) == 0
+
+    def clone(self, name):
+        """Copy the container from the image's golden snapshot, creating the snapshot on first use."""
+        golden = "golden-{}".format(image_key(self.image))
+        if not self.client.exists("/1.0/containers/{}/snapshots/golden".format(golden)):
+            if self.shell("ensure_golden", self.image) != 0:
+                return False
+        start = time.time()
+        self.client.call("POST", "/1.0/containers", {
+            "name": name, "profiles": PROFILES, "source": {"type": "copy", "source": golden + "/golden"},
+        })
+        self.client.set_state(name, "start")
+        self.record_timing("clone", start)
+        return self.wait_ready(name)
+
+    def start_container(self):
+        """Claim a warm container for the job, or create one."""
+        claimed = self.claim_pool_container()
+        if claimed:
+            self.container = claimed
+            self.log("Claimed warm container {}".format(claimed))
+            self.record_metric("pool_claims_total", 1, image=self.image)
+            return True
+        self.record_metric("pool_misses_total", 1, image=self.image)
+        self.verify_profile()
+        # Record the job before its container exists, so reap.sh does not take it for a left over one.
+        with open(self.job_file, "w") as job_file:
+            job_file.write(self.container + "\n")
+        if self.config["clone_containers"]:
+            return self.clone(self.container)
+        return self.provision(self.container)
+
+    def job_limits(self):
+        """Return the CPU and memory limits the job asks for, within the maximums set in the charm.
+
+        Jobs ask for them with the LXD_CPU_LIMIT and LXD_MEMORY_LIMIT CI variables. With CPU
+        pinning, the job's concurrency slot is pinned to CPUs of its own.
+        """
+        limits = {}
+        cpus = self.config["cpu_limit"]
+        requested = self.environ.get("CUSTOM_ENV_LXD_CPU_LIMIT")
+        if requested:
+            maximum = self.config["cpu_limit_max"]
+            if re.match("^[1-9][0-9]*$", requested) and maximum and int(requested) <= int(maximum):
+                cpus = limits["limits.cpu"] = requested
+            else:
+                self.log("Ignoring LXD_CPU_LIMIT={}, the maximum is {} CPUs".format(requested, maximum or 0))
+        if self.config["cpu_pinning"] and re.match("^[1-9][0-9]*$", cpus):
+            slots = os.cpu_count() // int(cpus)
+            if slots > 0:
+                first = int(self.environ.get("CUSTOM_ENV_CI_CONCURRENT_ID") or 0) % slots * int(cpus)
+                limits["limits.cpu"] = "{}-{}".format(first, first + int(cpus) - 1)
+        requested = self.environ.get("CUSTOM_ENV_LXD_MEMORY_LIMIT")
+        if requested:
+            maximum = self.config["memory_limit_max"]
+            if 0 < size_bytes(requested) and maximum and size_bytes(requested) <= size_bytes(maximum):
+                limits["limits.memory"] = requested
+            else:
+                self.log("Ignoring LXD_MEMORY_LIMIT={}, the maximum is {}".format(requested, maximum or 0))
+        return limits
+
+    def apply_job_limits(self):
+        """Apply the job's own resource limits on top of the defaults of the gitlab profile."""
+        limits = self.job_limits()
+        if limits:
+            self.client.call("PATCH", "/1.0/containers/{}".format(self.container), {"config": limits})
+
+    def attach_volume(self, volume, path):
+        """Attach a persistent custom storage volume, creating it with a quota on first use."""
+        volumes = "/1.0/storage-pools/{}/volumes".format(STORAGE_POOL)
+        if not self.client.exists("{}/custom/{}".format(volumes, volume)):
+            self.log("Creating volume {}".format(volume))
+            try:
+                self.client.call("POST", volumes, {"name": volume, "type": "custom",
+                                                   "config": {"size": self.config["cache_volume_size"]}})
+            except LXDError:
+                # Another job of the same project may have just created it.
+                if not self.client.exists("{}/custom/{}".format(volumes, volume)):
+                    raise
+        marker = os.path.join(self.state_dir, "volumes", volume)
+        with open(marker, "a"):
+            os.utime(marker)
+        self.client.call("PATCH", "/1.0/containers/{}".format(self.container), {
+            "devices": {volume: {"type": "disk", "pool": STORAGE_POOL, "source": volume, "path": path}},
+        })
+
+    def attach_volumes(self):
+        """Attach the project's persistent cache volumes."""
+        if not self.config["cache_volumes"]:
+            return
+        self.attach_volume("cache-project-{}".format(self.project), "/cache")
+        if self.config["persist_builds"]:
+            # One per concurrency slot, so a git checkout is reused by the next job in the slot.
+            self.attach_volume("builds-project-{}-concurrent-{}".format(
+                self.project, self.environ.get("CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID", "")), "/builds")
+        # Make room for new volumes in the background, off the job's critical path.
+        self.shell("evict_volumes", background=True)
+
+    def mount_tmpfs(self, path, size):
+        """Mount a size-capped tmpfs in the container, unless the host is short of the memory to back it."""
+        size = size_bytes(size)
+        if not size:
+            return False
+        if memory_available() < size:
+            self.log("Not enough free memory for a {} byte tmpfs at {}, keeping it on disk".format(size, path))
+            self.record_metric("tmpfs_fallbacks_total", 1, path=path)
+            return False
+        command = "mkdir -p {0} && mount -t tmpfs -o size={1},mode=1777 tmpfs {0}".format(path, size)
+        if self.client.exec(self.container, ["sh", "-c", command]) != 0:
+            raise LXDError("Could not mount a tmpfs at {}".format(path))
+        return True
+
+    def mount_scratch(self):
+        """Move the job's /builds, and optionally /tmp, off the container's root filesystem.
+
+        /builds goes on a tmpfs while the host has the memory for it, or else on a volume of its own
+        in the builds storage pool. A persistent builds volume takes precedence.
+        """
+        if not (self.config["cache_volumes"] and self.config["persist_builds"]):
+            if self.config["builds_tmpfs_size"] and self.mount_tmpfs("/builds", self.config["builds_tmpfs_size"]):
+                self.record_metric("scratch_mounts_total", 1, path="/builds", type="tmpfs")
+            elif self.config["builds_storage_pool"]:
+                pool = self.config["builds_storage_pool"]
+                volume = "builds-{}".format(self.container)
+                self.client.call("POST", "/1.0/storage-pools/{}/volumes".format(pool),
+                                 {"name": volume, "type": "custom", "config": {}})
+                self.client.call("PATCH", "/1.0/containers/{}".format(self.container), {
+                    "devices": {volume: {"type": "disk", "pool": pool, "source": volume, "path": "/builds"}},
+                })
+                self.record_metric("scratch_mounts_total", 1, path="/builds", type="volume")
+        if self.config["tmp_tmpfs_size"] and self.mount_tmpfs("/tmp", self.config["tmp_tmpfs_size"]):
+            self.record_metric("scratch_mounts_total", 1, path="/tmp", type="tmpfs")
+
+    def remove_scratch(self):
+        """Delete the /builds volume of the deleted container of a previous attempt of this job."""
+        pool = self.config["builds_storage_pool"]
+        path = "/1.0/storage-pools/{}/volumes/custom/builds-{}".format(pool, self.container)
+        if pool and self.client.exists(path):
+            self.client.call("DELETE", path)
+
+    def prepare(self):
+        """Prepare the job's container. Returns False on failure."""
+        start = time.time()
+        self.log("Running in {}".format(self.job_name))
+        self.remove_old_container()
+        if not self.start_container():
+            return False
+        self.apply_job_limits()
+        self.attach_volumes()
+        self.mount_scratch()
+        self.record_timing("prepare", start)
+        return True
+
+    def record_output(self, pipe, stage):
+        """Record how much output a job stage produced."""
+        labels = {"stage": stage, "project": self.project}
+        self.record_metric("log_bytes_total", pipe.bytes, **labels)
+        self.record_metric("log_lines_total", pipe.lines, **labels)
+        if pipe.truncated:
+            self.record_metric("log_truncated_total", 1, **labels)
+
+    def pipe_output(self, source, stage):
+        """Stream output read from source to stdout through a LogPipe, as the shell run stage does."""
+        pipe = LogPipe(sys.stdout.buffer, self.config["output_limit"] * 1024)
+        try:
+            while True:
+                data = source.read1(LOG_CHUNK)
+                if not data:
+                    break
+                pipe.write(data)
+        finally:
+            pipe.close()
+        self.record_output(pipe, stage)
+
+    def run(self, script, stage):
+        """Run a job script in the container, streaming its output. Returns its exit code."""
+        start = time.time()
+        stage = stage or "script"
+        # GitLab Runner merges both streams into the job log anyway.
+        pipe = LogPipe(sys.stdout.buffer, self.config["output_limit"] * 1024)
+        try:
+            with open(script, "rb") as stdin:
+                code = self.client.exec(self.container, ["/bin/bash"], stdin=stdin, stdout=pipe, stderr=pipe)
+        finally:
+            pipe.close()
+        self.record_output(pipe, stage)
+        self.record_timing(stage, start)
+        return code
+
+    def dispose_container(self):
+        """Queue the job's container for the dispose worker, like dispose_container in base.sh."""
+        dispose_dir = os.path.join(self.state_dir, "dispose")
+        with open(os.path.join(dispose_dir, ".new-" + self.container), "w") as entry:
+            entry.write("{} {}\n".format(self.image, self.project))
+        os.replace(os.path.join(dispose_dir, ".new-" + self.container), os.path.join(dispose_dir, self.container))
+
+    def cleanup(self):
+        """Hand the job's container to the dispose worker, so that no job waits for it to be deleted.
+
+        The container is queued before the job slot is freed, so the reaper never sees it without either.
+        """
+        self.log("Deleting container {}".format(self.container))
+        self.dispose_container()
+        if os.path.exists(self.job_file):
+            os.remove(self.job_file)
+
+
+def main(argv):
+    """Run an executor stage: prepare, run <script> <stage> or cleanup, or pipe job output with logpipe <stage>."""
+    with open(os.path.join(EXECUTOR_DIR, "executor.json"), "r") as config_file:
+        config = json.load(config_file)
+    system_failure = int(os.environ.get("SYSTEM_FAILURE_EXIT_CODE", 1))
+    build_failure = int(os.environ.get("BUILD_FAILURE_EXIT_CODE", 1))
+    executor = Executor(config, LXDClient())
+    stage = argv[1] if len(argv) > 1 else None
+    try:
+        if stage == "prepare":
+            return 0 if executor.prepare() else system_failure
+        if stage == "run":
+            return 0 if executor.run(argv[2], argv[3] if len(argv) > 3 else None) == 0 else build_failure
+        if stage == "cleanup":
+            executor.cleanup()
+            return 0
+        if stage == "logpipe":
+            executor.pipe_output(sys.stdin.buffer, argv[2] if len(argv) > 2 else "script")
+            return 0
+    except (LXDError, OSError, http.client.HTTPException) as error:
+        print("LXD executor {} failed: {}".format(stage, error), file=sys.stderr, flush=True)
+        return system_failure
+    print("Usage: {} prepare|run <script> <stage>|cleanup|logpipe <stage>".format(argv[0]), file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
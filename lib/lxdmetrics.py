@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Prometheus exporter for the samples recorded by the LXD executor scripts.
+
+The executor scripts append one sample per line to samples.log in the metrics directory::
+
+    <name> <value> [<label>=<value> ...]
+
+Samples named in HISTOGRAMS are observed into histograms, any other sample is added to a counter.
+This module only uses the standard library, as it runs outside of the charm's virtualenv.
+"""
+import argparse
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PREFIX = "lxd_executor_"
+HISTOGRAMS = {
+    "phase_duration_seconds": [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600],
+}
+
+
+def parse_sample(line):
+    """Return the name, labels and value of a sample line, or None if it is malformed."""
+    fields = line.split()
+    if len(fields) < 2:
+        return None
+    try:
+        value = float(fields[1])
+    except ValueError:
+        return None
+    labels = []
+    for field in fields[2:]:
+        key, sep, label = field.partition("=")
+        if not sep:
+            return None
+        labels.append((key, label))
+    return fields[0], tuple(sorted(labels)), value
+
+
+def format_labels(labels, extra=()):
+    """Format label pairs in the Prometheus text format."""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in pairs) + "}"
+
+
+class Collector:
+    """Aggregate samples into counters and histograms."""
+
+    def __init__(self, metrics_dir):
+        """Collect samples from metrics_dir."""
+        self.metrics_dir = metrics_dir
+        self.samples_file = os.path.join(metrics_dir, "samples.log")
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.collect_lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        """Add one sample."""
+        with self.lock:
+            if name in HISTOGRAMS:
+                buckets = HISTOGRAMS[name]
+                histogram = self.histograms.setdefault((name, labels), [[0] * len(buckets), 0.0, 0])
+                for index, bound in enumerate(buckets):
+                    if value <= bound:
+                        histogram[0][index] += 1
+                histogram[1] += value
+                histogram[2] += 1
+            else:
+                self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def collect(self):
+        """Consume the samples written since the last collection.
+
+        The samples file is renamed before reading, so writers start a new file instead of
+        appending to one being read.
+        """
+        processing = "{}.{}".format(self.samples_file, os.getpid())
+        with self.collect_lock:
+            try:
+                os.rename(self.samples_file, processing)
+            except FileNotFoundError:
+                return 0
+            # Let a writer that opened the file just before the rename finish its line.
+            time.sleep(0.1)
+            count = 0
+            with open(processing, "r") as samples:
+                for line in samples:
+                    sample = parse_sample(line)
+                    if sample:
+                        self.observe(*sample)
+                        count += 1
+            os.remove(processing)
+        return count
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                for bound, bucket in zip(HISTOGRAMS[name], counts):
+                    lines.append("{}{}_bucket{} {}".format(PREFIX, name, format_labels(labels, [("le", str(bound))]),
+                                                           bucket))
+                lines.append("{}{}_bucket{} {}".format(PREFIX, name, format_labels(labels, [("le", "+Inf")]), count))
+                lines.append("{}{}_sum{} {}".format(PREFIX, name, format_labels(labels), total))
+                lines.append("{}{}_count{} {}".format(PREFIX, name, format_labels(labels), count))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{}{}{} {}".format(PREFIX, name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Serve each scrape in its own thread."""
+
+    daemon_threads = True
+
+
+def make_handler(collector):
+    """Return a request handler serving the collector's metrics."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            collector.collect()
+            body = collector.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def main():
+    """Collect samples periodically and serve them over HTTP."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--listen", default=":9253", help="address to serve /metrics on")
+    parser.add_argument("--metrics-dir", default="/var/lib/lxd-executor/metrics")
+    parser.add_argument("--interval", type=float, default=15, help="seconds between collections")
+    args = parser.parse_args()
+
+    collector = Collector(args.metrics_dir)
+    host, _, port = args.listen.rpartition(":")
+    server = ThreadingHTTPServer((host, int(port)), make_handler(collector))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while True:
+        collector.collect()
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""Adjust the GitLab Runner concurrency to the pressure on the host.
+
+Every interval the host is sampled: pressure stall information (PSI) for CPU, memory and IO, or
+the load average and memory use on kernels without PSI, disk usage, and the number of running jobs.
+The concurrent setting of config.toml goes down a step after down-samples overloaded samples in a
+row, and up a step after up-samples samples in a row that are well below the thresholds while every
+job slot is in use, always staying between --min and --max. The limit of each runner is scaled in
+proportion. GitLab Runner reloads config.toml by itself when it changes. The file is only
+rewritten while holding config_lock, which the charm also takes when it changes the file.
+
+This module only uses the standard library, as it runs outside of the charm's virtualenv.
+"""
+import argparse
+import contextlib
+import fcntl
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+PRESSURE_DIR = "/proc/pressure"
+CONCURRENT = re.compile(r"^concurrent\s*=\s*(\d+)\s*$")
+SECTION = re.compile(r"^\s*\[")
+NAME = re.compile(r'^\s*name\s*=\s*"(.*)"\s*$')
+LIMIT = re.compile(r"^(\s*)limit\s*=\s*\d+\s*$")
+
+
+def scaled_limit(limit, base_concurrency, concurrent):
+    """Return a runner's job limit scaled from the base concurrency to the current one, 0 staying unlimited."""
+    if limit <= 0:
+        return limit
+    return max(1, int(round(limit * concurrent / max(1, base_concurrency))))
+
+
+def read_pressure(resource):
+    """Return the share of the last 10 seconds some tasks stalled on a resource, in percent, or None without PSI."""
+    try:
+        with open(os.path.join(PRESSURE_DIR, resource), "r") as pressure:
+            for line in pressure:
+                fields = line.split()
+                if fields and fields[0] == "some":
+                    return float(dict(field.split("=", 1) for field in fields[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def memory_used():
+    """Return the share of memory in use, in percent."""
+    info = {}
+    with open("/proc/meminfo", "r") as meminfo:
+        for line in meminfo:
+            key, _, value = line.partition(":")
+            info[key] = int(value.split()[0])
+    return 100.0 * (1 - info["MemAvailable"] / info["MemTotal"])
+
+
+def disk_used(path):
+    """Return the share of the filesystem of path in use, in percent."""
+    usage = shutil.disk_usage(path)
+    return 100.0 * usage.used / usage.total
+
+
+def running_jobs(state_dir):
+    """Return the number of running jobs: LXD job slots in use and Docker job containers.
+
+    LXD job slots are only counted while their container exists, as a job abandoned by a runner
+    restart leaves its slot behind until the reaper removes it.
+    """
+    jobs_dir = os.path.join(state_dir, "jobs")
+    slots = []
+    try:
+        for name in os.listdir(jobs_dir):
+            if not name.startswith("."):
+                with open(os.path.join(jobs_dir, name), "r") as slot:
+                    slots.append(slot.read().strip())
+    except FileNotFoundError:
+        pass
+    jobs = 0
+    if slots:
+        try:
+            containers = subprocess.check_output(
+                ["lxc", "list", "--format", "csv", "--columns", "n"], stderr=subprocess.DEVNULL
+            ).decode().split()
+        except (OSError, subprocess.CalledProcessError):
+            containers = []
+        jobs = len([container for container in slots if container in containers])
+    try:
+        containers = subprocess.check_output(
+            ["docker", "ps", "--quiet", "--filter", "label=com.gitlab.gitlab-runner.job.id"],
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return jobs
+    return jobs + len(containers.split())
+
+
+def sample(args):
+    """Return the host pressure readings, each as a (value, threshold) pair, and the running jobs."""
+    readings = {}
+    for resource, threshold in [("cpu", args.cpu_pressure), ("memory", args.memory_pressure),
+                                ("io", args.io_pressure)]:
+        pressure = read_pressure(resource)
+        if pressure is not None:
+            readings[resource] = (pressure, threshold)
+    if "cpu" not in readings:
+        readings["load"] = (100.0 * os.getloadavg()[0] / (os.cpu_count() or 1), args.load)
+    if "memory" not in readings:
+        readings["memory_used"] = (memory_used(), args.memory_watermark)
+    for path in args.disk_path:
+        if os.path.exists(path):
+            readings["disk:" + path] = (disk_used(path), args.disk_watermark)
+    return readings, running_jobs(args.state_dir)
+
+
+def update_config(text, concurrent, limits):
+    """Return config.toml text with concurrent and the limit of each runner named in limits replaced."""
+    output = []
+    in_globals = True
+    runner = None
+    for line in text.splitlines(True):
+        if SECTION.match(line):
+            in_globals = False
+            runner = {} if line.strip() == "[[runners]]" else None
+        elif in_globals and CONCURRENT.match(line):
+            line = "concurrent = {}\n".format(concurrent)
+        elif runner is not None:
+            name = NAME.match(line)
+            if name:
+                runner["name"] = name.group(1)
+            limit = LIMIT.match(line)
+            if limit and runner.get("name") in limits:
+                line = "{}limit = {}\n".format(limit.group(1), limits[runner["name"]])
+        output.append(line)
+    return "".join(output)
+
+
+def read_concurrent(text):
+    """Return the global concurrent setting of config.toml text, or None."""
+    for line in text.splitlines():
+        if SECTION.match(line):
+            return None
+        match = CONCURRENT.match(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+@contextlib.contextmanager
+def config_lock(path):
+    """Hold the exclusive lock, on a file next to the configuration, that every writer of it takes."""
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def write_config(path, text):
+    """Replace the configuration file atomically, keeping it private."""
+    fd, tmp_path = tempfile.mkstemp(prefix=".config", suffix=".toml", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            os.fchmod(tmp_file.fileno(), 0o600)
+            tmp_file.write(text)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class Autoscaler:
+    """Decide concurrency changes from host samples, with separate thresholds and dwell times up and down."""
+
+    def __init__(self, minimum, maximum, up_samples=4, down_samples=2, low_ratio=0.5):
+        """Scale between minimum and maximum."""
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.up_samples = up_samples
+        self.down_samples = down_samples
+        self.low_ratio = low_ratio
+        self.overloaded = 0
+        self.idle = 0
+
+    def decide(self, concurrent, readings, jobs):
+        """Return the concurrency to use after a sample."""
+        if any(value > threshold for value, threshold in readings.values()):
+            self.overloaded += 1
+            self.idle = 0
+        elif jobs >= concurrent and all(value < threshold * self.low_ratio for value, threshold in readings.values()):
+            self.idle += 1
+            self.overloaded = 0
+        else:
+            self.overloaded = self.idle = 0
+        target = min(max(concurrent, self.minimum), self.maximum)
+        if self.overloaded >= self.down_samples:
+            target = max(self.minimum, target - 1)
+        elif self.idle >= self.up_samples:
+            target = min(self.maximum, target + 1)
+        if target != concurrent:
+            self.overloaded = self.idle = 0
+        return target
+
+
+def parse_limit(value):
+    """Parse a runner base limit given as name=limit."""
+    name, sep, limit = value.rpartition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected name=limit, got {}".format(value))
+    return name, int(limit)
+
+
+def main():
+    """Sample the host and adjust the runner concurrency forever."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", default="/etc/gitlab-runner/config.toml")
+    parser.add_argument("--state-dir", default="/var/lib/lxd-executor")
+    parser.add_argument("--min", type=int, default=1, dest="minimum")
+    parser.add_argument("--max", type=int, required=True, dest="maximum")
+    parser.add_argument("--base-concurrency", type=int, required=True,
+                        help="concurrency the base runner limits are set for")
+    parser.add_argument("--limit", type=parse_limit, action="append", default=[],
+                        help="base job limit of a runner, as name=limit")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between samples")
+    parser.add_argument("--cpu-pressure", type=float, default=40, help="CPU PSI percent that is overloaded")
+    parser.add_argument("--memory-pressure", type=float, default=10, help="memory PSI percent that is overloaded")
+    parser.add_argument("--io-pressure", type=float, default=40, help="IO PSI percent that is overloaded")
+    parser.add_argument("--load", type=float, default=150, help="load per CPU, in percent, that is overloaded")
+    parser.add_argument("--memory-watermark", type=float, default=90, help="memory use percent that is overloaded")
+    parser.add_argument("--disk-watermark", type=float, default=90, help="disk use percent that is overloaded")
+    parser.add_argument("--disk-path", action="append", default=["/"], help="filesystem whose use is watched")
+    args = parser.parse_args()
+
+    autoscaler = Autoscaler(args.minimum, args.maximum)
+    base_limits = dict(args.limit)
+    while True:
+        time.sleep(args.interval)
+        if not os.path.exists(args.config):
+            continue
+        readings, jobs = sample(args)
+        # Sampling runs commands, so the file is only read once the lock is held, right before it is replaced.
+        with config_lock(args.config):
+            try:
+                with open(args.config, "r") as cfg_file:
+                    text = cfg_file.read()
+            except FileNotFoundError:
+                continue
+            concurrent = read_concurrent(text)
+            if concurrent is None:
+                continue
+            target = autoscaler.decide(concurrent, readings, jobs)
+            if target == concurrent:
+                continue
+            limits = {name: scaled_limit(limit, args.base_concurrency, target) for name, limit in base_limits.items()}
+            print("Scaling concurrent from {} to {} with {} jobs running: {}".format(
+                concurrent, target, jobs, ", ".join("{}={:.1f}".format(key, value)
+                                                    for key, (value, _) in sorted(readings.items()))), flush=True)
+            write_config(args.config, update_config(text, target, limits))
+
+
+if __name__ == "__main__":
+    main()
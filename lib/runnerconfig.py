@@ -0,0 +1,94 @@
+"""Model of the GitLab Runner config.toml file."""
+import os
+import tempfile
+
+import toml
+
+
+class RunnerConfig:
+    """Load, modify and atomically save the GitLab Runner configuration."""
+
+    def __init__(self, path):
+        """Load the configuration file at path, which may not exist yet."""
+        self.path = path
+        self.loaded = {}
+        self.data = {}
+        self.load()
+
+    def load(self):
+        """Read the configuration file, discarding any unsaved changes."""
+        try:
+            with open(self.path, "r") as cfg_file:
+                # Round-trip what was read, as toml drops the empty tables GitLab Runner writes,
+                # which would otherwise make an unmodified configuration look changed.
+                self.loaded = toml.loads(toml.dumps(toml.load(cfg_file)))
+        except FileNotFoundError:
+            self.loaded = {}
+        self.data = toml.loads(toml.dumps(self.loaded))
+
+    @property
+    def runners(self):
+        """Return the [[runners]] sections, use add_runners to add any."""
+        return self.data.get("runners", [])
+
+    def runner(self, name):
+        """Return the [[runners]] section of the named runner, or None."""
+        for runner in self.runners:
+            if runner.get("name") == name:
+                return runner
+        return None
+
+    def add_runners(self, text):
+        """Add the [[runners]] sections found in a configuration written by gitlab-runner register."""
+        added = toml.loads(text).get("runners", [])
+        self.data.setdefault("runners", []).extend(added)
+        return [runner["name"] for runner in added]
+
+    def set_global(self, key, value):
+        """Set a global setting, or remove it when value is None."""
+        if value is None:
+            self.data.pop(key, None)
+        else:
+            self.data[key] = value
+
+    def set_runner(self, name, key, value, section=None):
+        """Set a setting of the named runner, optionally within a section such as docker.
+
+        The setting is removed when value is None. Returns False if there is no such runner.
+        """
+        runner = self.runner(name)
+        if runner is None:
+            return False
+        if section:
+            runner = runner.setdefault(section, {})
+        if value is None:
+            runner.pop(key, None)
+        else:
+            runner[key] = value
+        return True
+
+    @property
+    def changed(self):
+        """Return whether the configuration differs from the file."""
+        return self.data != self.loaded
+
+    def save(self):
+        """Write the configuration if it changed, replacing the file atomically.
+
+        GitLab Runner reloads its configuration whenever the file is written, so unchanged
+        configuration is never written. Returns whether the file was written.
+        """
+        if not self.changed:
+            return False
+        cfg_dir = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(prefix=".config", suffix=".toml", dir=cfg_dir)
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                os.fchmod(tmp_file.fileno(), 0o600)
+                tmp_file.write(toml.dumps(self.data))
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.loaded = toml.loads(toml.dumps(self.data))
+        return True
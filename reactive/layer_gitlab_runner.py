@@ -6,17 +6,94 @@ from charms.reactive import (
     endpoint_from_flag,
     set_flag,
     when,
+    when_any,
     when_not,
     hook,
 )
 
 from libgitlabrunner import GitLabRunner
 
-glr = GitLabRunner()
+# Configuration options by what they configure, so a change only redoes the work it affects.
+RUNNER_OPTIONS = [
+    "runners",
+    "concurrency",
+    "concurrency-min",
+    "concurrency-max",
+    "check-interval",
+    "metrics-listen-address",
+    "output-limit",
+    "docker-limit",
+    "lxd-limit",
+    "request-concurrency",
+    "docker-image",
+    "docker-pull-policy",
+    "docker-volumes",
+    "docker-shm-size",
+]
+DOCKER_DAEMON_OPTIONS = [
+    "local-cache",
+    "docker-registry-mirrors",
+    "docker-max-concurrent-downloads",
+    "docker-storage-driver",
+]
+LXD_OPTIONS = [
+    "lxd-storage-backend",
+    "lxd-storage-device",
+    "lxd-storage-size",
+    "lxd-storage-zfs-compression",
+    "lxd-images",
+    "lxd-warm-pool-size",
+    "lxd-prebuilt-images",
+    "lxd-tools-version",
+    "lxd-clone-containers",
+    "lxd-boot-timeout",
+    "lxd-executor-driver",
+    "output-limit",
+    "lxd-cache-volumes",
+    "lxd-cache-volume-size",
+    "lxd-cache-evict-threshold",
+    "lxd-persist-builds",
+    "lxd-builds-tmpfs-size",
+    "lxd-tmp-tmpfs-size",
+    "lxd-builds-storage-pool",
+    "lxd-cpu-limit",
+    "lxd-cpu-limit-max",
+    "lxd-cpu-pinning",
+    "lxd-memory-limit",
+    "lxd-memory-limit-max",
+    "lxd-processes-limit",
+    "lxd-disk-io-limit",
+    "lxd-cleanup-workers",
+    "lxd-recycle-containers",
+    "lxd-reaper-max-age",
+    "lxd-reaper-batch-size",
+    "local-cache",
+    "docker-image",
+    "docker-hot-images",
+    "image-refresh-interval",
+    "image-prune-watermark",
+    "executor-metrics-listen-address",
+]
+
+_glr = None
+
+
+def gitlab_runner():
+    """Return the GitLab Runner helper, created on first use so hooks that do not use it skip its setup."""
+    global _glr
+    if _glr is None:
+        _glr = GitLabRunner()
+    return _glr
+
+
+def changed(options):
+    """Return the flags set when any of the options changes."""
+    return ["config.changed.{}".format(option) for option in options]
 
 
 @hook('upgrade-charm')
 def handle_upgrade():
+    glr = gitlab_runner()
     if not glr.kv.get('apt_key') == glr.apt_key:
         glr.add_sources()
 
@@ -24,7 +101,7 @@ def handle_upgrade():
 @when_not("layer-gitlab-runner.installed")
 def install_gitlab_runner():
     """Run upgrade helper function when GitLab Runner has not been installed previously to perform initial install."""
-    glr.upgrade()
+    gitlab_runner().upgrade()
     hookenv.status_set("blocked", "Ready for registration via action or relation")
     set_flag("layer-gitlab-runner.installed")
 
@@ -32,27 +109,53 @@ def install_gitlab_runner():
 @when_not("layer-gitlab-runner.lxd_setup")
 def setup_lxd_executor():
     """Set up custom executor scripts for lxd executor."""
-    glr.setup_lxd()
+    gitlab_runner().setup_lxd()
     set_flag("layer-gitlab-runner.lxd_setup")
 
 
 @when_not("layer-gitlab-runner.docker_installed")
 def install_docker():
     """Install docker during initial charm install as required by the GitLab Runner Docker executor."""
-    glr.install_docker()
+    gitlab_runner().install_docker()
     set_flag("layer-gitlab-runner.docker_installed")
 
 
-@when("config.changed", "layer-gitlab-runner.installed")
-def configure_and_enable_gitlab_runner():
-    """Register, configure, and start the GitLab Runner and supporting services as configuration changes."""
-    glr.configure()
+@when("layer-gitlab-runner.installed")
+@when_any(*changed(RUNNER_OPTIONS))
+def configure_gitlab_runner():
+    """Update the GitLab Runner configuration and its autoscaler as their options change."""
+    glr = gitlab_runner()
+    glr.set_global_config()
+    glr.configure_autoscaler()
+
+
+@when("layer-gitlab-runner.installed", "layer-gitlab-runner.docker_installed")
+@when_any(*changed(DOCKER_DAEMON_OPTIONS))
+def configure_local_cache():
+    """Update the local caches and the Docker daemon as their options change."""
+    gitlab_runner().configure_local_cache()
+
+
+@when("layer-gitlab-runner.lxd_setup")
+@when_any(*changed(LXD_OPTIONS))
+def configure_lxd_executor():
+    """Re-render the LXD executor and its services as their options change."""
+    gitlab_runner().configure_lxd()
+
+
+@when("layer-gitlab-runner.installed", "config.changed.runners")
+def register_extra_runners():
+    """Register, re-register or unregister runners as the runners option changes, once the unit is registered."""
+    glr = gitlab_runner()
+    if glr.kv.get("registered_runners"):
+        glr.register()
 
 
 @when("endpoint.runner.available")
 @when_not("runner.registered")
 def register_runner():
     """Register runner via relation."""
+    glr = gitlab_runner()
     endpoint = endpoint_from_flag("endpoint.runner.available")
     uri, token = endpoint.get_server_credentials()
     glr.gitlab_token = token
@@ -60,7 +163,6 @@ def register_runner():
     glr.kv.set("gitlab_token", token)
     glr.kv.set("gitlab_uri", uri)
     hookenv.log("Registering runner url/token: {}/{}".format(uri, token))
-    glr.unregister()
     glr.register()
     set_flag("runner.registered")
 
@@ -69,6 +171,10 @@ def register_runner():
 def handle_relation_departed():
     """Handle runner relation departure."""
     clear_flag("runner.registered")
+    glr = gitlab_runner()
     glr.kv.set("gitlab_token", None)
     glr.kv.set("gitlab_uri", None)
-    glr.unregister()
+    # Only the runners of the relation go, the runners option keeps its runners and their tokens.
+    glr.gitlab_token = glr.charm_config["gitlab-token"] or None
+    glr.gitlab_uri = glr.charm_config["gitlab-uri"] or None
+    glr.register()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""Provide settings, fixtures and the results file of the benchmarks.
+
+The benchmarks are configured with environment variables:
+
+BENCH_CONCURRENCY   jobs run at the same time by the executor benchmark (4)
+BENCH_JOBS          jobs run in total by the executor benchmark (20)
+BENCH_ITERATIONS    runs of each timed hook path (20)
+BENCH_LXC_LATENCY   seconds each command of the stub lxc client takes (0.01)
+BENCH_OUTPUT_LINES  lines of output each benchmark job prints (1000)
+BENCH_DRIVER        executor driver to benchmark, shell or python (shell)
+BENCH_REAL_LXD      set to run the executor stages against the local LXD instead of the stub lxc
+BENCH_RESULTS       path of the JSON results file (report/benchmark/results.json)
+"""
+import json
+import math
+import os
+
+from charmhelpers.core import unitdata
+
+import mock
+
+import pytest
+
+SETTINGS = {
+    "concurrency": int(os.environ.get("BENCH_CONCURRENCY", 4)),
+    "jobs": int(os.environ.get("BENCH_JOBS", 20)),
+    "iterations": int(os.environ.get("BENCH_ITERATIONS", 20)),
+    "lxc_latency": float(os.environ.get("BENCH_LXC_LATENCY", 0.01)),
+    "output_lines": int(os.environ.get("BENCH_OUTPUT_LINES", 1000)),
+    "driver": os.environ.get("BENCH_DRIVER", "shell"),
+    "real_lxd": bool(os.environ.get("BENCH_REAL_LXD")),
+}
+RESULTS_FILE = os.environ.get("BENCH_RESULTS", "report/benchmark/results.json")
+
+
+def percentiles(samples):
+    """Summarize durations in seconds with nearest-rank percentiles."""
+    ordered = sorted(samples)
+
+    def rank(percent):
+        return ordered[max(0, int(math.ceil(percent / 100.0 * len(ordered))) - 1)]
+
+    return {
+        "count": len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": ordered[-1],
+    }
+
+
+@pytest.fixture(scope="session")
+def results():
+    """Collect the results of all benchmarks, and write them to the results file at the end."""
+    collected = {"settings": SETTINGS, "executor": {}, "hooks": {}}
+    yield collected
+    results_dir = os.path.dirname(RESULTS_FILE)
+    if results_dir:
+        os.makedirs(results_dir, exist_ok=True)
+    with open(RESULTS_FILE, "w") as results_file:
+        json.dump(collected, results_file, indent=2, sort_keys=True)
+        results_file.write("\n")
+
+
+@pytest.fixture
+def gitlabrunner(tmpdir, monkeypatch):
+    """Return the GitLab runner helper with the charm environment mocked and its paths in tmpdir."""
+    import yaml
+
+    with open("./config.yaml") as config_file:
+        options = yaml.safe_load(config_file)["options"]
+    config = {key: value["default"] for key, value in options.items()}
+    monkeypatch.setattr("libgitlabrunner.hookenv.config", lambda: config)
+    monkeypatch.setattr("libgitlabrunner.hookenv.charm_dir", lambda: ".")
+    monkeypatch.setattr("libgitlabrunner.hookenv.log", mock.Mock())
+    monkeypatch.setattr("libgitlabrunner.hookenv.status_set", mock.Mock())
+    monkeypatch.setattr("libgitlabrunner.unitdata.kv", lambda: unitdata.Storage(path=":memory:"))
+    # Files are owned by the user running the benchmarks instead of gitlab-runner.
+    owner = mock.Mock(pw_uid=os.getuid(), gr_gid=os.getgid())
+    monkeypatch.setattr("libgitlabrunner.templating.host.pwd.getpwnam", lambda name: owner)
+    monkeypatch.setattr("libgitlabrunner.templating.host.grp.getgrnam", lambda name: owner)
+
+    from libgitlabrunner import GitLabRunner
+
+    glr = GitLabRunner()
+    glr.hostname = "bench"
+    glr.executor_dir = tmpdir.mkdir("executor").strpath
+    glr.state_dir = tmpdir.mkdir("state").strpath
+    glr.systemd_dir = tmpdir.mkdir("systemd").strpath
+    glr.docker_daemon_file = tmpdir.join("daemon.json").strpath
+    glr.registry_cfg_file = tmpdir.join("registry.yml").strpath
+    glr.apt_lists_dir = tmpdir.join("apt-lists").strpath
+    glr.runner_cfg_file = tmpdir.join("config.toml").strpath
+    return glr
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""Benchmark the LXD executor stage latency and the runtime of the charm hook paths."""
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+
+import pytest
+
+from conftest import SETTINGS, percentiles
+
+STUB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin")
+STAGES = ["prepare", "run", "cleanup"]
+
+
+def job_environment(job):
+    """Return the environment GitLab Runner gives the executor stages of a job."""
+    environ = dict(
+        os.environ,
+        SYSTEM_FAILURE_EXIT_CODE="1",
+        BUILD_FAILURE_EXIT_CODE="2",
+        CUSTOM_ENV_CI_RUNNER_ID="1",
+        CUSTOM_ENV_CI_PROJECT_ID=str(job % 3),
+        CUSTOM_ENV_CI_CONCURRENT_ID=str(job % SETTINGS["concurrency"]),
+        CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID=str(job % SETTINGS["concurrency"]),
+        CUSTOM_ENV_CI_JOB_ID=str(1000 + job),
+        CUSTOM_ENV_CI_JOB_IMAGE="ubuntu:18.04",
+    )
+    if not SETTINGS["real_lxd"]:
+        environ["PATH"] = STUB_DIR + os.pathsep + environ["PATH"]
+    return environ
+
+
+def test_executor_stages(gitlabrunner, results, tmpdir):
+    """Run jobs through the prepare, run and cleanup stages at the configured concurrency."""
+    if SETTINGS["driver"] == "python" and not SETTINGS["real_lxd"]:
+        pytest.skip("the python driver talks to the LXD API, set BENCH_REAL_LXD to benchmark it")
+    gitlabrunner.charm_config["lxd-executor-driver"] = SETTINGS["driver"]
+    gitlabrunner.render_executor()
+    script = tmpdir.join("build_script")
+    script.write("for i in $(seq {}); do echo \"benchmark output line $i\"; done\n".format(SETTINGS["output_lines"]))
+
+    def run_job(job):
+        environ = job_environment(job)
+        timings = {}
+        for stage in STAGES:
+            command = [os.path.join(gitlabrunner.executor_dir, stage + ".sh")]
+            if stage == "run":
+                command.extend([script.strpath, "build_script"])
+            start = time.perf_counter()
+            subprocess.run(command, env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            timings[stage] = time.perf_counter() - start
+        timings["job"] = sum(timings.values())
+        return timings
+
+    with ThreadPoolExecutor(max_workers=SETTINGS["concurrency"]) as pool:
+        timings = list(pool.map(run_job, range(SETTINGS["jobs"])))
+    for stage in STAGES + ["job"]:
+        results["executor"][stage] = percentiles([timing[stage] for timing in timings])
+    assert results["executor"]["job"]["count"] == SETTINGS["jobs"]
+
+
+def register_runner(command, stderr=None):
+    """Stand in for gitlab-runner register, writing the runner to the configuration it is given."""
+    if command[1] == "register":
+        name = command[command.index("--name") + 1]
+        with open(command[-1], "a") as cfg_file:
+            cfg_file.write('concurrent = 1\n\n[[runners]]\n  name = "{}"\n  token = "t"\n'.format(name))
+
+
+def reset_register(glr, iteration):
+    """Start each registration from an unregistered unit."""
+    with open(glr.runner_cfg_file, "w") as cfg_file:
+        cfg_file.write("concurrent = 3\n")
+    glr.kv.set("registered_runners", {})
+
+
+def reset_set_global_config(glr, iteration):
+    """Change a setting, so that every run writes the configuration."""
+    glr.charm_config["check-interval"] = iteration
+
+
+def reset_setup_lxd(glr, iteration):
+    """Forget the storage pool, so that every run initialises LXD."""
+    glr.kv.unset("lxd_storage")
+
+
+@pytest.mark.parametrize("hook, reset", [
+    ("register", reset_register),
+    ("set_global_config", reset_set_global_config),
+    ("setup_lxd", reset_setup_lxd),
+])
+def test_hook_runtime(gitlabrunner, results, monkeypatch, hook, reset):
+    """Time a hook path of the charm, with the commands it runs mocked."""
+    monkeypatch.setattr("libgitlabrunner.subprocess.check_call", mock.Mock(side_effect=register_runner))
+    monkeypatch.setattr("libgitlabrunner.subprocess.check_output", mock.Mock(return_value=b""))
+    for name in ["service", "apt_install", "add_user_to_group"]:
+        monkeypatch.setattr("libgitlabrunner." + name, mock.Mock())
+    gitlabrunner.gitlab_uri = "https://gitlab.example.com"
+    gitlabrunner.gitlab_token = "token"
+    reset(gitlabrunner, 0)
+    samples = []
+    for iteration in range(SETTINGS["iterations"]):
+        reset(gitlabrunner, iteration + 1)
+        start = time.perf_counter()
+        getattr(gitlabrunner, hook)()
+        samples.append(time.perf_counter() - start)
+    results["hooks"][hook] = percentiles(samples)
@@ -138,6 +138,15 @@ def mock_check_call(monkeypatch):
     return mocked_check_call
 
 
+@pytest.fixture
+def mock_check_output(monkeypatch):
+    """Mock check_output to return canned LXD image information."""
+    mocked_check_output = mock.Mock()
+    mocked_check_output.return_value = b"Fingerprint: 0123456789abcdef\nSize: 100.00MB\n"
+    monkeypatch.setattr("libgitlabrunner.subprocess.check_output", mocked_check_output)
+    return mocked_check_output
+
+
 @pytest.fixture
 def mock_log(monkeypatch):
     """Mock charm log functionality."""
@@ -162,6 +171,14 @@ def mock_action_set(monkeypatch):
     return mocked_action_set
 
 
+@pytest.fixture
+def mock_action_get(monkeypatch):
+    """Mock action_get to provide action parameters."""
+    mocked_action_get = mock.Mock(return_value=False)
+    monkeypatch.setattr("charmhelpers.core.hookenv.action_get", mocked_action_get)
+    return mocked_action_get
+
+
 @pytest.fixture
 def mock_action_fail(monkeypatch):
     """Mock action_fail to facilitate testing of action failure."""
@@ -186,6 +203,7 @@ def gitlabrunner(
     mock_template,
     mock_unit_db,
     mock_check_call,
+    mock_check_output,
     monkeypatch,
 ):
     """Mock the GitLab runner helper module used throughout the charm."""
@@ -195,6 +213,11 @@ def gitlabrunner(
 
     executor_dir = tmpdir
     glr.executor_dir = executor_dir
+    glr.state_dir = tmpdir.mkdir("state").strpath
+    glr.systemd_dir = tmpdir.mkdir("systemd").strpath
+    glr.docker_daemon_file = tmpdir.join("daemon.json").strpath
+    glr.registry_cfg_file = tmpdir.join("registry.yml").strpath
+    glr.apt_lists_dir = tmpdir.join("apt-lists").strpath
 
     # Example config file patching
     cfg_file = tmpdir.join("config.toml")
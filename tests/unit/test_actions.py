@@ -11,3 +11,47 @@ def test_register_action(gitlabrunner, monkeypatch, mock_action_set, mock_action
     assert mock_function.call_count == 0
     imp.load_source('register', './actions/register')
     assert mock_function.call_count == 1
+
+
+def test_register_action_registered(gitlabrunner, monkeypatch, mock_action_set, mock_action_fail):
+    """Unit test the register action does nothing when every runner is already registered."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(gitlabrunner, 'register', mock_function)
+    monkeypatch.setattr(gitlabrunner, 'pending_runners', lambda: {})
+    gitlabrunner.gitlab_token = "token"
+    gitlabrunner.gitlab_uri = "https://gitlab.example.com"
+    imp.load_source('register', './actions/register')
+    assert mock_function.call_count == 0
+    mock_action_set.assert_called_once_with({'output': 'All runners are already registered.'})
+
+
+def test_register_action_results(gitlabrunner, monkeypatch, mock_action_set, mock_action_fail):
+    """Unit test the register action reports the result of each runner."""
+    def register():
+        gitlabrunner.registration_results = {"unit-lxd": "registered", "unit-project-a": "failed"}
+        return False
+
+    monkeypatch.setattr(gitlabrunner, 'register', register)
+    imp.load_source('register', './actions/register')
+    mock_action_set.assert_called_once_with({'results': 'unit-lxd: registered, unit-project-a: failed'})
+    assert mock_action_fail.call_count == 1
+
+
+def test_build_images_action(gitlabrunner, monkeypatch, mock_action_get, mock_action_set, mock_action_fail):
+    """Unit test the build-images action."""
+    mock_function = mock.Mock(return_value={"ubuntu:18.04": "gitlab-runner-ubuntu-18-04-1"})
+    monkeypatch.setattr(gitlabrunner, 'build_images', mock_function)
+    imp.load_source('build_images', './actions/build-images')
+    mock_function.assert_called_once_with(force=False)
+    mock_action_set.assert_called_once()
+    assert mock_action_fail.call_count == 0
+
+
+def test_upgrade_action(gitlabrunner, monkeypatch, mock_action_set, mock_action_fail):
+    """Unit test the upgrade action."""
+    mock_function = mock.Mock()
+    monkeypatch.setattr(gitlabrunner, 'upgrade', mock_function)
+    imp.load_source('upgrade', './actions/upgrade')
+    mock_function.assert_called_once_with()
+    mock_action_set.assert_called_once_with({'output': 'Upgrade completed.'})
+    assert mock_action_fail.call_count == 0
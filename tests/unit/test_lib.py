@@ -1,9 +1,16 @@
 #!/usr/bin/python3
 """Unit test helper module functions."""
+import json
+import os
+import signal
 import subprocess
+import time
 
+import mock
 from mock import call
 
+from runnerconfig import RunnerConfig
+
 
 def test_pytest():
     """Verify pytest is working."""
@@ -30,6 +37,90 @@ def test_upgrade(
     mock_apt_install.assert_called_once()
 
 
+def test_upgrade_drains_jobs(
+    gitlabrunner,
+    tmpdir,
+    monkeypatch,
+    mock_apt_install,
+    mock_apt_update,
+    mock_check_output,
+    mock_get_distrib_codename,
+    mock_add_source,
+    mock_service,
+):
+    """Test GitLab Runner is stopped gracefully before an upgrade, and only when there is a newer version."""
+    with open(gitlabrunner.runner_cfg_file, "a") as cfgfile:
+        cfgfile.write('\n[[runners]]\n  name = "{}-lxd"\n  token = "t"\n'.format(gitlabrunner.hostname))
+    gitlabrunner.proc_dir = tmpdir.mkdir("proc").strpath
+    process = tmpdir.join("proc", "1234")
+    process.write("")
+    versions = b"gitlab-runner:\n  Installed: 12.0.0\n  Candidate: 12.1.0\n"
+    mock_check_output.side_effect = lambda command, **kwargs: \
+        versions if command[0] == "apt-cache" else b"MainPID=1234\n"
+    jobs = [2, 1]
+
+    def active_jobs():
+        if not jobs:
+            process.remove()
+            return 0
+        return jobs.pop(0)
+
+    mock_kill = mock.Mock()
+    monkeypatch.setattr("libgitlabrunner.os.kill", mock_kill)
+    monkeypatch.setattr(gitlabrunner, "active_jobs", active_jobs)
+    monkeypatch.setattr(gitlabrunner, "drain_poll_interval", 0)
+    gitlabrunner.upgrade()
+    mock_kill.assert_called_once_with(1234, signal.SIGQUIT)
+    assert mock_service.call_args_list[:2] == [call("stop", "gitlab-runner"), call("enable", "gitlab-runner")]
+    assert mock_apt_install.call_args_list == [
+        call("gitlab-runner", options=["--download-only"]),
+        call("gitlab-runner"),
+    ]
+
+    mock_kill.reset_mock()
+    mock_apt_install.reset_mock()
+    versions = b"gitlab-runner:\n  Installed: 12.1.0\n  Candidate: 12.1.0\n"
+    gitlabrunner.upgrade()
+    assert mock_kill.call_count == 0
+    mock_apt_install.assert_called_once_with("gitlab-runner")
+
+    process.write("")
+    gitlabrunner.charm_config["upgrade-drain-timeout"] = 0
+    assert not gitlabrunner.drain()
+
+
+def test_active_jobs(gitlabrunner, mock_check_output):
+    """Test job slots only count while their container exists, along with Docker job containers."""
+    jobs_dir = os.path.join(gitlabrunner.state_dir, "jobs")
+    os.mkdir(jobs_dir)
+    for slot, container in [("job-1", "pool-a"), ("job-2", "job-2"), ("job-3", "gone"), (".job-4", "pool-b")]:
+        with open(os.path.join(jobs_dir, slot), "w") as slot_file:
+            slot_file.write(container + "\n")
+    mock_check_output.side_effect = lambda command, **kwargs: \
+        b"pool-a\njob-2\npool-b\n" if command[0] == "lxc" else b"0123abcd\n"
+    assert gitlabrunner.active_jobs() == 3
+
+
+def test_apt_index_fresh(gitlabrunner, tmpdir):
+    """Test the APT index is only reused while it is recent and newer than every source."""
+    lists = tmpdir.mkdir("lists")
+    sources = tmpdir.mkdir("sources.list.d")
+    gitlabrunner.apt_lists_dir = lists.strpath
+    gitlabrunner.apt_sources_file = tmpdir.join("sources.list").strpath
+    gitlabrunner.apt_sources_dir = sources.strpath
+    assert gitlabrunner.apt_index_fresh()
+    now = time.time()
+    os.utime(sources.join("gitlab.list").ensure().strpath, (now + 10, now + 10))
+    assert not gitlabrunner.apt_index_fresh()
+    os.utime(lists.strpath, (now + 20, now + 20))
+    assert gitlabrunner.apt_index_fresh()
+    os.utime(lists.strpath, (now - 7200, now - 7200))
+    os.utime(sources.join("gitlab.list").strpath, (now - 7200, now - 7200))
+    assert not gitlabrunner.apt_index_fresh()
+    gitlabrunner.apt_lists_dir = tmpdir.join("missing").strpath
+    assert not gitlabrunner.apt_index_fresh()
+
+
 def test_register(
     gitlabrunner,
     mock_get_distrib_codename,
@@ -85,16 +176,116 @@ def test_register(
         "--custom-cleanup-exec",
         "/opt/lxd-executor/cleanup.sh",
     ]
-    calls = [call(test_docker, stderr=subprocess.STDOUT),
-             call(test_lxd, stderr=subprocess.STDOUT),
-             ]
-    mock_check_call.assert_has_calls(calls)
+    # Registrations run concurrently, each into its own scratch configuration file
+    commands = [args[0] for args, kwargs in mock_check_call.call_args_list]
+    assert sorted(command[:-2] for command in commands) == [test_docker, test_lxd]
+    assert all(command[-2] == "--config" for command in commands)
+    assert mock_check_call.call_count == 2
+
+
+def test_register_idempotent(gitlabrunner, mock_check_call):
+    """Test registration only registers runners that are missing or changed."""
+    def register_runner(command, stderr=None):
+        if command[1] == "register":
+            name = command[command.index("--name") + 1]
+            with open(command[-1], "a") as cfg_file:
+                cfg_file.write('concurrent = 1\n\n[[runners]]\n  name = "{}"\n  token = "t"\n'.format(name))
+
+    mock_check_call.side_effect = register_runner
+    gitlabrunner.gitlab_uri = "mocked-uri"
+    gitlabrunner.gitlab_token = "mocked-token"
+    gitlabrunner.hostname = "mocked-hostname"
+    assert gitlabrunner.register()
+    assert sorted(gitlabrunner.configured_runners()) == ["mocked-hostname-docker", "mocked-hostname-lxd"]
+    with open(gitlabrunner.runner_cfg_file, "r") as cfgfile:
+        assert cfgfile.read().startswith("concurrent = 0\ncheck_interval = 10\n")
+    assert mock_check_call.call_count == 2
+    gitlabrunner.register()
     assert mock_check_call.call_count == 2
+    gitlabrunner.gitlab_token = "new-token"
+    gitlabrunner.register()
+    mock_check_call.assert_any_call(
+        ["/usr/bin/gitlab-runner", "unregister", "--name", "mocked-hostname-lxd"], stderr=subprocess.STDOUT
+    )
+    assert mock_check_call.call_count == 6
+
+
+def test_extra_runners(gitlabrunner):
+    """Test runners from the runners option are named, defaulted and validated."""
+    gitlabrunner.hostname = "mocked-hostname"
+    gitlabrunner.charm_config["runners"] = """
+- uri: https://gitlab.example.com
+  token: token-a
+  tags: [lxd, bionic]
+  limit: 2
+  name: project-a
+- uri: https://gitlab.example.org
+  token: token-b
+  executor: docker
+- uri: https://gitlab.example.org
+  executor: shell
+- {uri: https://gitlab.example.org, token: token-c, limit: two}
+- {uri: https://gitlab.example.org, token: token-d, name: lxd}
+- {uri: https://gitlab.example.org, token: token-e, name: project-a}
+"""
+    runners = gitlabrunner.extra_runners()
+    assert runners["mocked-hostname-project-a"] == {
+        "uri": "https://gitlab.example.com", "token": "token-a", "tags": "lxd,bionic", "executor": "lxd", "limit": 2,
+    }
+    docker = [name for name in runners if name.startswith("mocked-hostname-docker-")]
+    assert len(runners) == 2 and len(docker) == 1
+    assert runners[docker[0]]["tags"] == "docker"
+    assert gitlabrunner.extra_runners() == runners
+    gitlabrunner.charm_config["runners"] = "uri: [unbalanced"
+    assert gitlabrunner.extra_runners() == {}
+
+
+def test_register_extra_runners(gitlabrunner, mock_check_call):
+    """Test runners for several GitLab instances share one configuration and are reported one by one."""
+    def register_runner(command, stderr=None):
+        if command[1] == "register":
+            if "token-b" in command:
+                raise subprocess.CalledProcessError(1, command)
+            name = command[command.index("--name") + 1]
+            with open(command[-1], "a") as cfg_file:
+                cfg_file.write('concurrent = 1\n\n[[runners]]\n  name = "{}"\n  token = "t"\n'.format(name))
+
+    mock_check_call.side_effect = register_runner
+    gitlabrunner.gitlab_uri = "mocked-uri"
+    gitlabrunner.gitlab_token = "mocked-token"
+    gitlabrunner.hostname = "mocked-hostname"
+    gitlabrunner.charm_config["runners"] = """
+- {uri: https://gitlab.example.com, token: token-a, name: project-a, limit: 2}
+- {uri: https://gitlab.example.org, token: token-b, name: project-b, executor: docker}
+"""
+    assert not gitlabrunner.register()
+    assert gitlabrunner.registration_results == {
+        "mocked-hostname-docker": "registered",
+        "mocked-hostname-lxd": "registered",
+        "mocked-hostname-project-a": "registered",
+        "mocked-hostname-project-b": "failed",
+    }
+    config = RunnerConfig(gitlabrunner.runner_cfg_file)
+    assert config.runner("mocked-hostname-project-a")["limit"] == 2
+    assert sorted(gitlabrunner.pending_runners()) == ["mocked-hostname-project-b"]
 
+    gitlabrunner.charm_config["runners"] = (
+        "- {uri: https://gitlab.example.com, token: token-a, tags: ci, name: project-a}"
+    )
+    assert gitlabrunner.register()
+    mock_check_call.assert_any_call(
+        ["/usr/bin/gitlab-runner", "unregister", "--name", "mocked-hostname-project-a"], stderr=subprocess.STDOUT
+    )
+    assert gitlabrunner.registration_results["mocked-hostname-docker"] == "already registered"
+    assert gitlabrunner.registration_results["mocked-hostname-project-a"] == "registered"
+    assert "mocked-hostname-project-b" not in gitlabrunner.registration_results
 
-def test_setup_lxd(gitlabrunner, mock_check_call):
-    """Test the setup_lxd function of the helper module."""
+
+def test_setup_lxd(gitlabrunner, mock_check_call, mock_service):
+    """Test the setup_lxd and configure_lxd functions of the helper module, as run on install."""
     gitlabrunner.setup_lxd()
+    assert not os.path.exists(gitlabrunner.executor_dir+"/base.sh")
+    gitlabrunner.configure_lxd()
     with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
         contents = basefile.read()
         assert "# /opt/lxd-executor/base.sh" in contents
@@ -107,7 +298,333 @@ def test_setup_lxd(gitlabrunner, mock_check_call):
     with open(gitlabrunner.executor_dir+"/cleanup.sh", "r") as basefile:
         contents = basefile.read()
         assert "# /opt/lxd-executor/cleanup.sh" in contents
+    with open(gitlabrunner.executor_dir+"/pool.sh", "r") as basefile:
+        contents = basefile.read()
+        assert "# /opt/lxd-executor/pool.sh" in contents
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        assert "POOL_SIZE=0\n" in basefile.read()
+    # group membership, lxd init, 6 profile and 1 network settings, building the image, daemon-reload
+    # and draining the disabled pool, daemon-reload for the dispose worker, the reaper, the image refresh
+    # and the exporter
+    assert mock_check_call.call_count == 16
+    mock_service.assert_any_call("disable", "lxd-executor-pool.service")
+
+
+def test_configure_lxd_host(gitlabrunner, mock_check_call, mock_check_output):
+    """Test the profile and network settings are only applied when they changed."""
+    mock_check_output.side_effect = [subprocess.CalledProcessError(1, "lxc"), b""]
+    assert gitlabrunner.configure_lxd_host()
+    mock_check_call.assert_has_calls([
+        call(["lxc", "profile", "create", "gitlab"], stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "unset", "gitlab", "limits.cpu"], stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "unset", "gitlab", "limits.memory"], stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "unset", "gitlab", "limits.processes"], stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "set", "gitlab", "raw.lxc", "lxc.apparmor.profile=unconfined\nlxc.mount.auto=sys:rw\n"],
+             stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "set", "gitlab", "security.nesting", "true"], stderr=subprocess.STDOUT),
+        call(["lxc", "profile", "set", "gitlab", "security.privileged", "true"], stderr=subprocess.STDOUT),
+        call(["lxc", "network", "set", "lxdbr0", "dns.domain", "juju-gitlab-runner"], stderr=subprocess.STDOUT),
+    ])
+    assert not gitlabrunner.configure_lxd_host()
+    assert mock_check_call.call_count == 8
+    gitlabrunner.render_executor()
+    with open(gitlabrunner.executor_dir+"/prepare.sh", "r") as preparefile:
+        contents = preparefile.read()
+        assert "lxc network set" not in contents
+        assert "verify_profile" in contents
+
+
+def test_configure_job_limits(gitlabrunner, mock_check_call, mock_check_output):
+    """Test the default job limits are set in the gitlab profile."""
+    gitlabrunner.charm_config["lxd-cpu-limit"] = "2"
+    gitlabrunner.charm_config["lxd-memory-limit"] = "4GB"
+    gitlabrunner.charm_config["lxd-processes-limit"] = 2000
+    gitlabrunner.charm_config["lxd-disk-io-limit"] = "100MB"
+    gitlabrunner.charm_config["lxd-cpu-pinning"] = True
+    assert gitlabrunner.configure_lxd_host()
+    mock_check_call.assert_any_call(["lxc", "profile", "set", "gitlab", "limits.cpu", "2"], stderr=subprocess.STDOUT)
+    mock_check_call.assert_any_call(
+        ["lxc", "profile", "set", "gitlab", "limits.memory", "4GB"], stderr=subprocess.STDOUT
+    )
+    mock_check_call.assert_any_call(
+        ["lxc", "profile", "set", "gitlab", "limits.processes", "2000"], stderr=subprocess.STDOUT
+    )
+    mock_check_call.assert_any_call(
+        ["lxc", "profile", "device", "add", "gitlab", "root", "disk", "path=/", "pool=default", "limits.max=100MB"],
+        stderr=subprocess.STDOUT,
+    )
+    gitlabrunner.charm_config["lxd-disk-io-limit"] = ""
+    mock_check_output.return_value = b"root\n"
+    assert gitlabrunner.configure_lxd_host()
+    mock_check_call.assert_any_call(["lxc", "profile", "device", "remove", "gitlab", "root"],
+                                    stderr=subprocess.STDOUT)
+    gitlabrunner.render_executor()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        assert "CPU_PINNING=true\n" in basefile.read()
+
+
+def test_setup_lxd_storage_backend(gitlabrunner, mock_check_call, mock_check_output, mock_service, mock_apt_install):
+    """Test setup_lxd creates a copy-on-write capable storage pool and clones containers."""
+    gitlabrunner.charm_config["lxd-storage-backend"] = "zfs"
+    gitlabrunner.charm_config["lxd-clone-containers"] = True
+    gitlabrunner.setup_lxd()
+    gitlabrunner.configure_lxd()
+    mock_apt_install.assert_called_once_with(["zfsutils-linux"])
+    preseed = gitlabrunner.lxd_preseed(gitlabrunner.lxd_storage_settings())
+    assert preseed["storage_pools"] == [{"name": "default", "driver": "zfs", "config": {}}]
+    mock_check_output.assert_any_call(
+        ["lxd", "init", "--preseed"], input=json.dumps(preseed).encode(), stderr=subprocess.STDOUT
+    )
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        contents = basefile.read()
+        assert "CLONE_CONTAINERS=true\n" in contents
+        assert "BOOT_TIMEOUT=60\n" in contents
+
+
+def test_configure_lxd_storage(gitlabrunner, mock_check_call, mock_check_output, mock_apt_install, mock_log):
+    """Test the storage pool is created once from the preseed, and only its tunables change afterwards."""
+    gitlabrunner.charm_config.update({
+        "lxd-storage-backend": "lvm-thin", "lxd-storage-device": "/dev/nvme0n1",
+        "lxd-storage-size": "100GB",
+    })
+    preseed = gitlabrunner.lxd_preseed(gitlabrunner.lxd_storage_settings())
+    assert preseed["storage_pools"][0] == {
+        "name": "default", "driver": "lvm", "config": {"source": "/dev/nvme0n1", "lvm.use_thinpool": "true"},
+    }
+    assert gitlabrunner.configure_lxd_storage()
+    mock_apt_install.assert_called_once_with(["lvm2", "thin-provisioning-tools"])
+    mock_check_output.assert_any_call(
+        ["lxd", "init", "--preseed"], input=json.dumps(preseed).encode(), stderr=subprocess.STDOUT
+    )
+    assert mock_check_output.call_args_list[-1][0][0] == ["lxc", "storage", "show", "default"]
+    assert not gitlabrunner.configure_lxd_storage()
+
+    # The pool keeps its backend, so ZFS tunables do not apply to it.
+    gitlabrunner.kv.set("lxd_storage_driver", "lvm")
+    gitlabrunner.charm_config.update({"lxd-storage-backend": "zfs", "lxd-storage-zfs-compression": "lz4"})
+    calls = mock_check_output.call_count
+    assert gitlabrunner.configure_lxd_storage()
+    assert mock_check_output.call_count == calls
+    assert mock_check_call.call_count == 0
+    assert "only apply to new units" in mock_log.call_args_list[-1][0][0]
+
+    # A unit set up by an older charm has a pool, but no record of its settings.
+    gitlabrunner.kv.unset("lxd_storage")
+    gitlabrunner.kv.unset("lxd_storage_driver")
+    mock_check_output.return_value = b"config:\n  source: default\nname: default\ndriver: zfs\n"
+    mock_log.reset_mock()
+    assert gitlabrunner.configure_lxd_storage()
+    assert mock_check_output.call_count == calls + 1
+    mock_check_call.assert_called_once_with(["zfs", "set", "compression=lz4", "default"], stderr=subprocess.STDOUT)
+    assert not any("only apply to new units" in args[0] for args, _ in mock_log.call_args_list)
+    assert gitlabrunner.kv.get("lxd_storage_driver") == "zfs"
+
+
+def test_configure_warm_pool(gitlabrunner, mock_check_call, mock_service):
+    """Test the warm pool daemon is started when a pool size is configured."""
+    gitlabrunner.charm_config["lxd-warm-pool-size"] = 2
+    gitlabrunner.configure_lxd()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        contents = basefile.read()
+        assert "POOL_SIZE=2\n" in contents
+        assert 'POOL_IMAGES="ubuntu:18.04"' in contents
+    with open(gitlabrunner.systemd_dir+"/lxd-executor-pool.service", "r") as unitfile:
+        assert "ExecStart={}/pool.sh".format(gitlabrunner.executor_dir) in unitfile.read()
+    mock_service.assert_any_call("enable", "lxd-executor-pool.service")
+    mock_service.assert_any_call("restart", "lxd-executor-pool.service")
+
+
+def test_configure_dispose(gitlabrunner, mock_check_call, mock_service):
+    """Test finished job containers are queued for the dispose worker, which may recycle them."""
+    gitlabrunner.charm_config["lxd-cleanup-workers"] = 4
+    gitlabrunner.charm_config["lxd-recycle-containers"] = True
+    gitlabrunner.configure_lxd()
+    with open(gitlabrunner.executor_dir+"/dispose.sh", "r") as disposefile:
+        assert "WORKERS=4\n" in disposefile.read()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        assert "RECYCLE_CONTAINERS=true\n" in basefile.read()
+    with open(gitlabrunner.systemd_dir+"/lxd-executor-dispose.service", "r") as unitfile:
+        assert "ExecStart={}/dispose.sh".format(gitlabrunner.executor_dir) in unitfile.read()
+    mock_service.assert_any_call("restart", "lxd-executor-dispose.service")
+
+
+def test_configure_image_refresh(gitlabrunner, mock_check_call, mock_service):
+    """Test the hot images are refreshed and pruned periodically, and refreshes can be disabled."""
+    gitlabrunner.charm_config["docker-hot-images"] = "python:3.8 ubuntu:latest"
+    gitlabrunner.configure_lxd()
+    with open(gitlabrunner.executor_dir+"/images.sh", "r") as imagesfile:
+        contents = imagesfile.read()
+        assert 'DOCKER_IMAGES="ubuntu:latest python:3.8"\n' in contents
+        assert "PRUNE_WATERMARK=85\n" in contents
+        assert "{{.DockerRootDir}}" in contents
+    with open(gitlabrunner.systemd_dir+"/gitlab-runner-images.timer", "r") as unitfile:
+        assert "OnUnitInactiveSec=360min" in unitfile.read()
+    mock_service.assert_any_call("enable", "gitlab-runner-images.timer")
+    gitlabrunner.charm_config["image-refresh-interval"] = 0
+    gitlabrunner.configure_image_refresh()
+    mock_service.assert_any_call("disable", "gitlab-runner-images.timer")
+
+
+def test_configure_reaper(gitlabrunner, mock_check_call, mock_service):
+    """Test left over job containers are reaped periodically instead of deleted by the next job."""
+    gitlabrunner.charm_config["lxd-reaper-max-age"] = 120
+    gitlabrunner.configure_lxd()
+    with open(gitlabrunner.executor_dir+"/reap.sh", "r") as reapfile:
+        assert "REAP_MAX_AGE=120\n" in reapfile.read()
+    with open(gitlabrunner.systemd_dir+"/lxd-executor-reaper.service", "r") as unitfile:
+        assert "ExecStart={}/reap.sh".format(gitlabrunner.executor_dir) in unitfile.read()
+    assert os.path.exists(gitlabrunner.systemd_dir+"/lxd-executor-reaper.timer")
+    mock_service.assert_any_call("enable", "lxd-executor-reaper.timer")
+    with open(gitlabrunner.executor_dir+"/cleanup.sh", "r") as cleanupfile:
+        assert 'dispose_container "$CONTAINER_ID"' in cleanupfile.read()
+
+
+def test_render_cache_volumes(gitlabrunner):
+    """Test persistent cache volumes are configured in the rendered executor."""
+    gitlabrunner.charm_config["lxd-cache-volumes"] = True
+    gitlabrunner.charm_config["lxd-cache-volume-size"] = "20GB"
+    gitlabrunner.render_executor()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        contents = basefile.read()
+        assert "CACHE_VOLUMES=true\n" in contents
+        assert 'CACHE_VOLUME_SIZE="20GB"\n' in contents
+        assert "PERSIST_BUILDS=false\n" in contents
+    with open(gitlabrunner.executor_dir+"/prepare.sh", "r") as preparefile:
+        assert '"cache-project-${CUSTOM_ENV_CI_PROJECT_ID}" "$CONTAINER_ID" /cache' in preparefile.read()
+
+
+def test_render_scratch_mounts(gitlabrunner):
+    """Test tmpfs and storage pool backed /builds are configured in the rendered executor."""
+    gitlabrunner.charm_config["lxd-builds-tmpfs-size"] = "8GB"
+    gitlabrunner.charm_config["lxd-builds-storage-pool"] = "nvme"
+    gitlabrunner.render_executor()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        contents = basefile.read()
+        assert 'BUILDS_TMPFS_SIZE="8GB"\n' in contents
+        assert 'TMP_TMPFS_SIZE=""\n' in contents
+        assert 'BUILDS_STORAGE_POOL="nvme"\n' in contents
+    with open(gitlabrunner.executor_dir+"/prepare.sh", "r") as preparefile:
+        assert 'mount_scratch "$CONTAINER_ID"' in preparefile.read()
+
+
+def test_render_python_driver(gitlabrunner):
+    """Test the job stages are handed to the Python driver, which gets the executor settings."""
+    gitlabrunner.charm_config["lxd-executor-driver"] = "python"
+    gitlabrunner.render_executor()
+    for stage in ["prepare", "run", "cleanup"]:
+        with open(gitlabrunner.executor_dir+"/{}.sh".format(stage), "r") as stagefile:
+            assert "lxdexecutor.py {} \"$@\"".format(stage) in stagefile.read()
+    with open(gitlabrunner.executor_dir+"/executor.json", "r") as configfile:
+        assert json.load(configfile)["boot_timeout"] == 60
+    assert gitlabrunner.executor_dir.join("lxdexecutor.py").check()
+
+
+def test_configure_local_cache(gitlabrunner, mock_check_call, mock_service, mock_apt_install):
+    """Test the local caches are installed and Docker is pointed at the registry mirror."""
+    gitlabrunner.charm_config["local-cache"] = True
+    gitlabrunner.configure_local_cache()
+    mock_apt_install.assert_called_once_with(["apt-cacher-ng", "docker-registry"])
+    mock_service.assert_any_call("restart", "docker-registry")
+    mock_service.assert_any_call("restart", "docker")
+    with open(gitlabrunner.docker_daemon_file, "r") as daemon_file:
+        assert json.load(daemon_file) == {"registry-mirrors": ["http://127.0.0.1:5000"]}
+    with open(gitlabrunner.registry_cfg_file, "r") as registry_file:
+        assert "remoteurl: https://registry-1.docker.io" in registry_file.read()
+    mock_service.reset_mock()
+    gitlabrunner.configure_local_cache()
+    assert call("restart", "docker") not in mock_service.mock_calls
+    gitlabrunner.charm_config["local-cache"] = False
+    gitlabrunner.configure_local_cache()
+    mock_service.assert_any_call("stop", "apt-cacher-ng")
+    mock_service.assert_any_call("restart", "docker")
+
+
+def test_configure_metrics(gitlabrunner, mock_check_call, mock_service):
+    """Test the executor metrics exporter and GitLab Runner metrics are enabled."""
+    gitlabrunner.charm_config["executor-metrics-listen-address"] = ":9253"
+    gitlabrunner.charm_config["metrics-listen-address"] = ":9252"
+    gitlabrunner.configure_lxd()
+    gitlabrunner.set_global_config()
+    with open(gitlabrunner.executor_dir+"/base.sh", "r") as basefile:
+        assert "METRICS=true\n" in basefile.read()
+    with open(gitlabrunner.systemd_dir+"/lxd-executor-exporter.service", "r") as unitfile:
+        assert "lxdmetrics.py --listen :9253" in unitfile.read()
+    assert gitlabrunner.executor_dir.join("lxdmetrics.py").check()
+    mock_service.assert_any_call("restart", "lxd-executor-exporter.service")
+    with open(gitlabrunner.runner_cfg_file, "r") as cfgfile:
+        assert 'listen_address = ":9252"' in cfgfile.read()
+
+
+def test_configure_autoscaler(gitlabrunner, mock_check_call, mock_service):
+    """Test the autoscaler runs within the concurrency bounds, and the charm keeps its concurrency."""
+    with open(gitlabrunner.runner_cfg_file, "a") as cfgfile:
+        cfgfile.write('\n[[runners]]\n  name = "{}-lxd"\n  token = "t"\n'.format(gitlabrunner.hostname))
+    gitlabrunner.charm_config.update({"concurrency": 4, "lxd-limit": "2"})
+    gitlabrunner.set_global_config()
+    gitlabrunner.charm_config.update({"concurrency-min": 2, "concurrency-max": 8})
+    gitlabrunner.configure_autoscaler()
+    with open(gitlabrunner.systemd_dir+"/gitlab-runner-autoscaler.service", "r") as unitfile:
+        assert "--min 2 --max 8 --base-concurrency 4 --limit {0}-docker=0 --limit {0}-lxd=2".format(
+            gitlabrunner.hostname) in unitfile.read()
+    assert gitlabrunner.executor_dir.join("runnerautoscaler.py").check()
+    mock_service.assert_any_call("restart", "gitlab-runner-autoscaler.service")
+    mock_service.reset_mock()
+    gitlabrunner.charm_config["check-interval"] = 30
+    gitlabrunner.configure_autoscaler()
+    assert mock_service.call_count == 0
+    gitlabrunner.set_global_config()
+    assert gitlabrunner.configured_runners()[gitlabrunner.hostname + "-lxd"]["limit"] == 2
+    with open(gitlabrunner.runner_cfg_file, "r") as cfgfile:
+        text = cfgfile.read()
+    with open(gitlabrunner.runner_cfg_file, "w") as cfgfile:
+        cfgfile.write(text.replace("concurrent = 4", "concurrent = 6"))
+    gitlabrunner.charm_config["output-limit"] = 8192
+    gitlabrunner.set_global_config()
+    with open(gitlabrunner.runner_cfg_file, "r") as cfgfile:
+        assert cfgfile.readline() == "concurrent = 6\n"
+    assert gitlabrunner.configured_runners()[gitlabrunner.hostname + "-lxd"]["limit"] == 3
+    gitlabrunner.charm_config["concurrency-max"] = 0
+    gitlabrunner.set_global_config()
+    with open(gitlabrunner.runner_cfg_file, "r") as cfgfile:
+        assert cfgfile.readline() == "concurrent = 4\n"
+    gitlabrunner.configure_autoscaler()
+    mock_service.assert_any_call("disable", "gitlab-runner-autoscaler.service")
+
+
+def test_build_images(gitlabrunner, mock_check_call, mock_check_output):
+    """Test pre-built images are only rebuilt when the inputs build-image.sh recorded change."""
+    images_dir = os.path.join(gitlabrunner.state_dir, "images")
+    os.mkdir(images_dir)
+
+    def build_image(command, stderr=None):
+        fingerprint = mock_check_output.return_value.decode().split()[1]
+        with open(os.path.join(images_dir, "ubuntu-18-04"), "w") as record:
+            record.write("{} false\n".format(fingerprint))
+
+    mock_check_call.side_effect = build_image
+    build = call([gitlabrunner.executor_dir + "/build-image.sh", "ubuntu:18.04"], stderr=subprocess.STDOUT)
+    images = gitlabrunner.build_images()
+    assert images == {"ubuntu:18.04": "gitlab-runner-ubuntu-18-04-1"}
+    mock_check_call.assert_has_calls([build])
+    assert mock_check_call.call_count == 1
+    gitlabrunner.build_images()
+    assert mock_check_call.call_count == 1
+    gitlabrunner.build_images(force=True)
+    mock_check_call.assert_called_with(
+        [gitlabrunner.executor_dir + "/build-image.sh", "ubuntu:18.04", "--force"], stderr=subprocess.STDOUT
+    )
+    gitlabrunner.charm_config["lxd-tools-version"] = "2"
+    assert gitlabrunner.build_images() == {"ubuntu:18.04": "gitlab-runner-ubuntu-18-04-2"}
     assert mock_check_call.call_count == 2
+    gitlabrunner.charm_config["local-cache"] = True
+    gitlabrunner.build_images()
+    assert mock_check_call.call_count == 3
+    gitlabrunner.charm_config["local-cache"] = False
+    # images.sh rebuilt the image from a new upstream version, so the charm leaves it alone.
+    mock_check_output.return_value = b"Fingerprint: fedcba9876543210\n"
+    build_image(None)
+    gitlabrunner.build_images()
+    assert mock_check_call.call_count == 3
 
 
 def test_set_global_config(gitlabrunner):
@@ -118,3 +635,64 @@ def test_set_global_config(gitlabrunner):
         contents = cfgfile.read()
         assert "concurrent = 3\n" in contents
         assert "check_interval = 0\n" in contents
+    assert not gitlabrunner.set_global_config()
+
+
+def test_set_runner_settings(gitlabrunner):
+    """Test per-runner settings are applied to the runners of this unit."""
+    with open(gitlabrunner.runner_cfg_file, "a") as cfgfile:
+        cfgfile.write('\n[[runners]]\n  name = "{}-lxd"\n  token = "t"\n'.format(gitlabrunner.hostname))
+    gitlabrunner.charm_config["output-limit"] = 8192
+    assert gitlabrunner.set_global_config()
+    assert gitlabrunner.configured_runners()[gitlabrunner.hostname + "-lxd"]["output_limit"] == 8192
+
+
+def test_set_docker_settings(gitlabrunner):
+    """Test the Docker runner settings are written to its [runners.docker] section."""
+    with open(gitlabrunner.runner_cfg_file, "a") as cfgfile:
+        cfgfile.write('\n[[runners]]\n  name = "{}-docker"\n  token = "t"\n'.format(gitlabrunner.hostname))
+    gitlabrunner.charm_config["docker-volumes"] = "/srv/cache:/cache /var/run/docker.sock:/var/run/docker.sock"
+    gitlabrunner.charm_config["docker-shm-size"] = 268435456
+    assert gitlabrunner.set_global_config()
+    docker = gitlabrunner.configured_runners()[gitlabrunner.hostname + "-docker"]["docker"]
+    assert docker == {
+        "image": "ubuntu:latest",
+        "pull_policy": "if-not-present",
+        "volumes": ["/srv/cache:/cache", "/var/run/docker.sock:/var/run/docker.sock"],
+        "shm_size": 268435456,
+    }
+    gitlabrunner.charm_config["docker-shm-size"] = 0
+    assert gitlabrunner.set_global_config()
+    assert "shm_size" not in gitlabrunner.configured_runners()[gitlabrunner.hostname + "-docker"]["docker"]
+
+
+def test_docker_daemon_config(gitlabrunner):
+    """Test the Docker daemon settings only include what is configured."""
+    assert gitlabrunner.docker_daemon_config() == {}
+    gitlabrunner.charm_config["local-cache"] = True
+    gitlabrunner.charm_config["docker-registry-mirrors"] = "https://mirror.example.com"
+    gitlabrunner.charm_config["docker-max-concurrent-downloads"] = 8
+    assert gitlabrunner.docker_daemon_config() == {
+        "registry-mirrors": ["http://127.0.0.1:5000", "https://mirror.example.com"],
+        "max-concurrent-downloads": 8,
+    }
+
+
+def test_runner_limits(gitlabrunner, monkeypatch):
+    """Test per-executor job limits, including limits derived from host resources."""
+    assert gitlabrunner.host_job_capacity() >= 1
+    monkeypatch.setattr(gitlabrunner, "host_job_capacity", lambda: 8)
+    assert gitlabrunner.runner_limits() == {"docker": 0, "lxd": 0}
+    gitlabrunner.charm_config["docker-limit"] = "2"
+    gitlabrunner.charm_config["lxd-limit"] = "auto"
+    assert gitlabrunner.runner_limits() == {"docker": 2, "lxd": 6}
+    gitlabrunner.charm_config["docker-limit"] = "auto"
+    assert gitlabrunner.runner_limits() == {"docker": 4, "lxd": 4}
+    gitlabrunner.charm_config["docker-limit"] = "2x"
+    gitlabrunner.charm_config["lxd-limit"] = "Auto"
+    assert gitlabrunner.runner_limits() == {"docker": 0, "lxd": 8}
+    gitlabrunner.charm_config["docker-limit"] = "auto"
+    gitlabrunner.charm_config["request-concurrency"] = 3
+    settings = gitlabrunner.runner_settings()[gitlabrunner.hostname + "-docker"]
+    assert settings["limit"] == 4
+    assert settings["request_concurrency"] == 3
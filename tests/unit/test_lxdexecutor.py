@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+"""Unit test the LXD executor driver."""
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import mock
+
+import pytest
+
+from lxdexecutor import Executor, LOG_BUFFER, LXDClient, LXDError, LogPipe, WS_BINARY, WS_CLOSE, WebSocket, size_bytes
+
+
+CONFIG = {
+    "state_dir": None,
+    "tools_version": "1",
+    "clone_containers": False,
+    "boot_timeout": 60,
+    "cache_volumes": False,
+    "cache_volume_size": "10GB",
+    "persist_builds": False,
+    "cpu_limit": "",
+    "cpu_limit_max": "",
+    "memory_limit_max": "",
+    "cpu_pinning": False,
+    "metrics": True,
+    "output_limit": 4096,
+    "builds_tmpfs_size": "",
+    "tmp_tmpfs_size": "",
+    "builds_storage_pool": "",
+}
+ENVIRON = {
+    "CUSTOM_ENV_CI_RUNNER_ID": "4",
+    "CUSTOM_ENV_CI_PROJECT_ID": "12",
+    "CUSTOM_ENV_CI_CONCURRENT_PROJECT_ID": "0",
+    "CUSTOM_ENV_CI_JOB_ID": "300",
+    "CUSTOM_ENV_CI_JOB_IMAGE": "ubuntu:18.04",
+}
+
+
+@pytest.fixture
+def state_dir(tmpdir):
+    """Create the state directory layout of the executor."""
+    for path in ["jobs", "pool", "volumes", "metrics", "dispose"]:
+        tmpdir.mkdir(path)
+    return tmpdir
+
+
+@pytest.fixture
+def lxd_socket(tmpdir):
+    """Serve a fake LXD API on a unix socket, answering from a dict of paths to responses."""
+    responses = {}
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def respond(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            requests.append((self.command, self.path, json.loads(self.rfile.read(length).decode() or "null")))
+            body = json.dumps(responses.get((self.command, self.path), {
+                "type": "error", "error": "not found", "error_code": 404,
+            })).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+        def address_string(self):
+            return "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+    path = tmpdir.join("unix.socket").strpath
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path, responses, requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_websocket_frames():
+    """Test masked client frames of every length encoding are read back, and pings are answered."""
+    client_sock, server_sock = socket.socketpair()
+    client, server = WebSocket(client_sock), WebSocket(server_sock)
+    for payload in [b"", b"x" * 125, b"y" * 1000, b"z" * 70000]:
+        client.send(payload)
+        assert server.recv() == (WS_BINARY, payload)
+    server.send(b"ping", 0x9)
+    server.send(b"data")
+    assert client.recv() == (WS_BINARY, b"data")
+    assert server._read_frame() == (True, 0xA, b"ping")
+    client.close()
+    assert server.recv()[0] == WS_CLOSE
+
+
+def test_client_call(lxd_socket):
+    """Test requests share one connection, and asynchronous operations are waited for."""
+    path, responses, requests = lxd_socket
+    responses[("PUT", "/1.0/containers/c1/state")] = {"type": "async", "operation": "/1.0/operations/op1"}
+    responses[("GET", "/1.0/operations/op1/wait")] = {"type": "sync", "metadata": {"status_code": 200}}
+    responses[("GET", "/1.0/containers/c1")] = {"type": "sync", "metadata": {"name": "c1"}}
+    client = LXDClient(path)
+    client.set_state("c1", "start")
+    assert client.exists("/1.0/containers/c1")
+    assert not client.exists("/1.0/containers/c2")
+    assert requests[0] == ("PUT", "/1.0/containers/c1/state", {"action": "start", "timeout": 30, "force": False})
+    assert len(requests) == 4
+    responses[("GET", "/1.0/operations/op1/wait")]["metadata"] = {"status_code": 400, "err": "boom"}
+    with pytest.raises(LXDError):
+        client.set_state("c1", "start")
+
+
+def test_client_retries(tmpdir):
+    """Test only GET and DELETE requests are replayed after a dropped connection."""
+    client = LXDClient(tmpdir.join("unix.socket").strpath)
+    client.connection = mock.Mock()
+    client.connection.getresponse.side_effect = [
+        ConnectionResetError(), mock.Mock(read=lambda: b'{"type": "sync", "metadata": {}}'),
+    ]
+    assert client.request("GET", "/1.0/containers/c1")["type"] == "sync"
+    assert client.connection.request.call_count == 2
+    client.connection.reset_mock()
+    client.connection.getresponse.side_effect = [ConnectionResetError()]
+    with pytest.raises(ConnectionResetError):
+        client.request("POST", "/1.0/containers", {"name": "c1"})
+    assert client.connection.request.call_count == 1
+
+
+def test_wait_ready_budget(state_dir, monkeypatch):
+    """Test each readiness attempt only polls for the boot time that is left."""
+    now = [1000.0]
+    monkeypatch.setattr("lxdexecutor.time.time", lambda: now[0])
+    monkeypatch.setattr("lxdexecutor.time.sleep", lambda seconds: None)
+    client = mock.Mock()
+
+    def exec(name, command):
+        now[0] += 45
+        return 1
+
+    client.exec.side_effect = exec
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), client, ENVIRON)
+    assert not executor.wait_ready("c1")
+    polls = [int(args[1][2].split("-lt ")[1].split(" ]")[0]) for args, _ in client.exec.call_args_list]
+    assert polls == [1200, 300]
+
+
+def test_claim_pool_container(state_dir):
+    """Test a warm container is claimed by moving its marker into the job slot."""
+    pool_dir = state_dir.join("pool").mkdir("ubuntu-18-04")
+    pool_dir.join("pool-ubuntu-18-04-abc").write("pool-ubuntu-18-04-abc\n")
+    pool_dir.join(".pool-ubuntu-18-04-def").write("pool-ubuntu-18-04-def\n")
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), mock.Mock(), ENVIRON)
+    assert executor.job_name == "runner-4-project-12-concurrent-0-300"
+    assert executor.claim_pool_container() == "pool-ubuntu-18-04-abc"
+    assert state_dir.join("jobs", executor.job_name).read() == "pool-ubuntu-18-04-abc\n"
+    assert executor.claim_pool_container() is None
+    assert Executor(dict(CONFIG, state_dir=state_dir.strpath), mock.Mock(), ENVIRON).container == \
+        "pool-ubuntu-18-04-abc"
+
+
+def test_size_bytes():
+    """Test LXD sizes are converted to bytes."""
+    assert size_bytes("4GB") == 4000000000
+    assert size_bytes("512MiB") == 536870912
+    assert size_bytes("1.5GB") == 1500000000
+    assert size_bytes("100") == 100
+    assert size_bytes("3XB") == 0
+    assert size_bytes("lots") == 0
+
+
+def test_job_limits(state_dir, monkeypatch):
+    """Test jobs get the limits they ask for up to the maximums, and slots are pinned to their own CPUs."""
+    monkeypatch.setattr("lxdexecutor.os.cpu_count", lambda: 8)
+    config = dict(CONFIG, state_dir=state_dir.strpath, cpu_limit="2", cpu_limit_max="4", memory_limit_max="8GB")
+    environ = dict(ENVIRON, CUSTOM_ENV_LXD_CPU_LIMIT="3", CUSTOM_ENV_LXD_MEMORY_LIMIT="6GB")
+    assert Executor(config, mock.Mock(), environ).job_limits() == {"limits.cpu": "3", "limits.memory": "6GB"}
+    environ = dict(ENVIRON, CUSTOM_ENV_LXD_CPU_LIMIT="16", CUSTOM_ENV_LXD_MEMORY_LIMIT="16GB")
+    assert Executor(config, mock.Mock(), environ).job_limits() == {}
+    assert Executor(dict(config, cpu_limit_max=""), mock.Mock(), dict(ENVIRON, CUSTOM_ENV_LXD_CPU_LIMIT="1")) \
+        .job_limits() == {}
+    config["cpu_pinning"] = True
+    environ = dict(ENVIRON, CUSTOM_ENV_CI_CONCURRENT_ID="5")
+    assert Executor(config, mock.Mock(), environ).job_limits() == {"limits.cpu": "2-3"}
+    environ["CUSTOM_ENV_LXD_CPU_LIMIT"] = "4"
+    assert Executor(config, mock.Mock(), environ).job_limits() == {"limits.cpu": "4-7"}
+
+
+def test_image_source(state_dir):
+    """Test images on the default lxc remotes are pulled, and other images are local aliases."""
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), mock.Mock(), ENVIRON)
+    assert executor.image_source("ubuntu:18.04") == {
+        "type": "image", "mode": "pull", "server": "https://cloud-images.ubuntu.com/releases",
+        "protocol": "simplestreams", "alias": "18.04",
+    }
+    assert executor.image_source("gitlab-runner-ubuntu-18-04-1") == {
+        "type": "image", "alias": "gitlab-runner-ubuntu-18-04-1",
+    }
+
+
+def test_prepare_baked_image(state_dir):
+    """Test a job container is launched from the pre-built image and its boot is timed."""
+    client = mock.Mock()
+    client.exists.side_effect = lambda path: path in [
+        "/1.0/profiles/gitlab", "/1.0/images/aliases/gitlab-runner-ubuntu-18-04-1",
+    ]
+    client.exec.return_value = 0
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), client, ENVIRON)
+    assert executor.prepare()
+    client.call.assert_any_call("POST", "/1.0/containers", {
+        "name": executor.job_name, "source": {"type": "image", "alias": "gitlab-runner-ubuntu-18-04-1"},
+        "profiles": ["default", "gitlab"],
+    })
+    client.set_state.assert_called_once_with(executor.job_name, "start")
+    assert state_dir.join("jobs", executor.job_name).read() == executor.job_name + "\n"
+    samples = state_dir.join("metrics", "samples.log").read()
+    assert "pool_misses_total 1 image=ubuntu:18.04\n" in samples
+    assert "phase=boot" in samples
+    assert "phase=prepare" in samples
+    assert state_dir.join("boot-times.log").read().split()[1] == executor.job_name
+
+
+def test_cleanup(state_dir):
+    """Test the container is queued for the dispose worker before its job slot is freed."""
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), mock.Mock(), ENVIRON)
+    state_dir.join("jobs", executor.job_name).write(executor.container + "\n")
+    removed = []
+    real_remove = os.remove
+
+    def remove(path):
+        removed.append((path, state_dir.join("dispose", executor.container).check()))
+        real_remove(path)
+
+    with mock.patch("lxdexecutor.os.remove", remove):
+        executor.cleanup()
+    assert removed == [(executor.job_file, True)]
+    assert state_dir.join("dispose", executor.container).read() == "ubuntu:18.04 12\n"
+    assert state_dir.join("dispose").listdir() == [state_dir.join("dispose", executor.container)]
+
+
+def test_log_pipe():
+    """Test small writes are coalesced, output past the limit is dropped, and a slow sink holds writers back."""
+    writes = []
+
+    class Sink:
+        def write(self, data):
+            assert len(data) <= LOG_BUFFER + 100
+            writes.append(data)
+
+        def flush(self):
+            pass
+
+    pipe = LogPipe(Sink())
+    for _ in range(1000):
+        pipe.write(b"line\n")
+    pipe.close()
+    assert b"".join(writes) == b"line\n" * 1000
+    assert len(writes) < 10
+    assert (pipe.bytes, pipe.lines, pipe.truncated) == (5000, 1000, False)
+
+    writes.clear()
+    pipe = LogPipe(Sink(), limit=12)
+    for _ in range(5):
+        pipe.write(b"line\n")
+    pipe.close()
+    output = b"".join(writes)
+    assert output.startswith(b"line\nline\nli\nJob output exceeded the limit of 12 bytes")
+    assert (pipe.bytes, pipe.lines, pipe.truncated) == (25, 5, True)
+
+
+def test_pipe_output(state_dir, capsysbinary):
+    """Test the shell run stage output is passed through and counted."""
+    executor = Executor(dict(CONFIG, state_dir=state_dir.strpath), mock.Mock(), ENVIRON)
+    executor.pipe_output(io.BufferedReader(io.BytesIO(b"hello\nworld\n")), "build_script")
+    assert capsysbinary.readouterr().out == b"hello\nworld\n"
+    samples = state_dir.join("metrics", "samples.log").read()
+    assert "log_bytes_total 12 project=12 stage=build_script\n" in samples
+    assert "log_lines_total 2 project=12 stage=build_script\n" in samples
+
+
+def test_mount_scratch(state_dir, monkeypatch):
+    """Test /builds goes on a tmpfs while memory allows, and on a volume of its own otherwise."""
+    monkeypatch.setattr("lxdexecutor.memory_available", lambda: 4 * 1024 ** 3)
+    client = mock.Mock()
+    client.exec.return_value = 0
+    config = dict(CONFIG, state_dir=state_dir.strpath, builds_tmpfs_size="2GiB", tmp_tmpfs_size="512MiB",
+                  builds_storage_pool="nvme")
+    executor = Executor(config, client, ENVIRON)
+    executor.mount_scratch()
+    client.exec.assert_any_call(executor.container, [
+        "sh", "-c", "mkdir -p /builds && mount -t tmpfs -o size=2147483648,mode=1777 tmpfs /builds"])
+    assert client.exec.call_count == 2
+    assert client.call.call_count == 0
+
+    client.reset_mock()
+    executor = Executor(dict(config, builds_tmpfs_size="8GiB"), client, ENVIRON)
+    executor.mount_scratch()
+    volume = "builds-" + executor.container
+    client.call.assert_any_call("PATCH", "/1.0/containers/" + executor.container, {
+        "devices": {volume: {"type": "disk", "pool": "nvme", "source": volume, "path": "/builds"}},
+    })
+    assert client.exec.call_count == 1
+    samples = state_dir.join("metrics", "samples.log").read()
+    assert "tmpfs_fallbacks_total 1 path=/builds\n" in samples
+    assert "scratch_mounts_total 1 path=/builds type=volume\n" in samples
@@ -0,0 +1,30 @@
+#!/usr/bin/python3
+"""Unit test the LXD executor metrics exporter."""
+from lxdmetrics import Collector, parse_sample
+
+
+def test_parse_sample():
+    """Test sample lines are parsed into a name, sorted labels and a value."""
+    assert parse_sample("phase_duration_seconds 1.5 project=12 image=ubuntu:18.04\n") == (
+        "phase_duration_seconds", (("image", "ubuntu:18.04"), ("project", "12")), 1.5)
+    assert parse_sample("pool_claims_total\n") is None
+    assert parse_sample("pool_claims_total x\n") is None
+
+
+def test_collect(tmpdir):
+    """Test samples are consumed into histograms and counters."""
+    samples = tmpdir.join("samples.log")
+    samples.write("phase_duration_seconds 0.2 phase=boot\n"
+                  "phase_duration_seconds 7 phase=boot\n"
+                  "pool_claims_total 1 image=ubuntu:18.04\n"
+                  "pool_claims_total 1 image=ubuntu:18.04\n")
+    collector = Collector(tmpdir.strpath)
+    assert collector.collect() == 4
+    assert not samples.check()
+    assert collector.collect() == 0
+    metrics = collector.render()
+    assert 'lxd_executor_phase_duration_seconds_bucket{phase="boot",le="0.25"} 1\n' in metrics
+    assert 'lxd_executor_phase_duration_seconds_bucket{phase="boot",le="10"} 2\n' in metrics
+    assert 'lxd_executor_phase_duration_seconds_bucket{phase="boot",le="+Inf"} 2\n' in metrics
+    assert 'lxd_executor_phase_duration_seconds_sum{phase="boot"} 7.2\n' in metrics
+    assert 'lxd_executor_pool_claims_total{image="ubuntu:18.04"} 2.0\n' in metrics
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+"""Unit test the GitLab Runner concurrency autoscaler."""
+import fcntl
+
+import mock
+
+import pytest
+
+from runnerautoscaler import (
+    Autoscaler, config_lock, read_concurrent, read_pressure, running_jobs, scaled_limit, update_config,
+)
+
+CONFIG = """concurrent = 4
+check_interval = 0
+
+[[runners]]
+name = "host-docker"
+limit = 2
+
+[runners.docker]
+image = "ubuntu:latest"
+
+[[runners]]
+name = "host-lxd"
+limit = 0
+"""
+
+
+def test_scaled_limit():
+    """Test runner limits follow the concurrency in proportion, unlimited runners staying unlimited."""
+    assert scaled_limit(2, 4, 6) == 3
+    assert scaled_limit(2, 4, 1) == 1
+    assert scaled_limit(0, 4, 8) == 0
+
+
+def test_update_config():
+    """Test only the global concurrent and the limits of the named runners are rewritten."""
+    text = update_config(CONFIG, 6, {"host-docker": 3, "host-lxd": 0})
+    assert text == CONFIG.replace("concurrent = 4", "concurrent = 6").replace("limit = 2", "limit = 3")
+    assert read_concurrent(text) == 6
+    assert read_concurrent("[[runners]]\nconcurrent = 1\n") is None
+
+
+def test_read_pressure(tmpdir, monkeypatch):
+    """Test the 10 second average of the some line is read, and missing PSI is None."""
+    monkeypatch.setattr("runnerautoscaler.PRESSURE_DIR", tmpdir.strpath)
+    tmpdir.join("cpu").write("some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n")
+    assert read_pressure("cpu") == 12.5
+    assert read_pressure("io") is None
+
+
+def test_autoscaler_hysteresis():
+    """Test scaling down needs sustained pressure, and scaling up sustained headroom with every slot busy."""
+    autoscaler = Autoscaler(2, 5, up_samples=3, down_samples=2)
+    high = {"cpu": (60.0, 40)}
+    moderate = {"cpu": (30.0, 40)}
+    low = {"cpu": (5.0, 40)}
+    assert autoscaler.decide(4, high, 4) == 4
+    assert autoscaler.decide(4, high, 4) == 3
+    assert autoscaler.decide(3, low, 3) == 3
+    assert autoscaler.decide(3, moderate, 3) == 3
+    assert [autoscaler.decide(3, low, 3) for _ in range(3)] == [3, 3, 4]
+    assert [autoscaler.decide(4, low, 2) for _ in range(5)] == [4] * 5
+    assert autoscaler.decide(5, low, 5) == 5
+    assert [autoscaler.decide(5, low, 5) for _ in range(3)] == [5] * 3
+    assert autoscaler.decide(9, moderate, 0) == 5
+    assert [autoscaler.decide(2, high, 2) for _ in range(4)] == [2] * 4
+
+
+def test_config_lock(tmpdir):
+    """Test the configuration lock is exclusive while held, and released afterwards."""
+    cfg_file = tmpdir.join("config.toml").strpath
+    with config_lock(cfg_file):
+        with open(cfg_file + ".lock", "a") as other:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    with open(cfg_file + ".lock", "a") as other:
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_running_jobs(tmpdir, monkeypatch):
+    """Test job slots only count while their container exists, along with Docker job containers."""
+    jobs_dir = tmpdir.mkdir("jobs")
+    for slot, container in [("job-1", "pool-a"), ("job-2", "job-2"), ("job-3", "gone"), (".job-4", "pool-b")]:
+        jobs_dir.join(slot).write(container + "\n")
+    monkeypatch.setattr("runnerautoscaler.subprocess.check_output", mock.Mock(
+        side_effect=lambda command, **kwargs: b"pool-a\njob-2\npool-b\n" if command[0] == "lxc" else b"0123abcd\n"))
+    assert running_jobs(tmpdir.strpath) == 3
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+"""Unit test the GitLab Runner configuration model."""
+import os
+
+from runnerconfig import RunnerConfig
+
+
+RUNNERS = """concurrent = 1
+check_interval = 0
+
+[[runners]]
+  name = "mocked-hostname-docker"
+  url = "mocked-uri"
+  token = "mocked-token"
+  executor = "docker"
+  [runners.custom_build_dir]
+  [runners.cache]
+    [runners.cache.s3]
+  [runners.docker]
+    image = "ubuntu:latest"
+"""
+
+
+def test_save_unchanged(tmpdir):
+    """Test an unchanged configuration is never rewritten."""
+    cfg_file = tmpdir.join("config.toml")
+    cfg_file.write(RUNNERS)
+    config = RunnerConfig(cfg_file.strpath)
+    config.set_global("concurrent", 1)
+    config.set_runner("mocked-hostname-docker", "image", "ubuntu:latest", section="docker")
+    assert not config.changed
+    assert not config.save()
+    assert cfg_file.read() == RUNNERS
+
+
+def test_no_runners_unchanged(tmpdir):
+    """Test reading the runners of a configuration without any does not change it."""
+    cfg_file = tmpdir.join("config.toml")
+    cfg_file.write("concurrent = 1\n")
+    config = RunnerConfig(cfg_file.strpath)
+    assert config.runners == []
+    assert not config.set_runner("missing", "limit", 2)
+    assert not config.changed
+
+
+def test_save_changed(tmpdir):
+    """Test global and per-runner settings are written atomically."""
+    cfg_file = tmpdir.join("config.toml")
+    cfg_file.write(RUNNERS)
+    config = RunnerConfig(cfg_file.strpath)
+    config.set_global("concurrent", 4)
+    assert config.set_runner("mocked-hostname-docker", "limit", 2)
+    assert not config.set_runner("missing", "limit", 2)
+    assert config.save()
+    assert not config.save()
+    assert oct(os.stat(cfg_file.strpath).st_mode & 0o777) == oct(0o600)
+    assert tmpdir.listdir() == [cfg_file]
+    saved = RunnerConfig(cfg_file.strpath)
+    assert saved.data["concurrent"] == 4
+    assert saved.runner("mocked-hostname-docker")["limit"] == 2
+    assert saved.runner("mocked-hostname-docker")["token"] == "mocked-token"
+    assert saved.runner("mocked-hostname-docker")["docker"]["image"] == "ubuntu:latest"
+
+
+def test_add_runners(tmpdir):
+    """Test runners registered into another file are added to the configuration."""
+    config = RunnerConfig(tmpdir.join("missing.toml").strpath)
+    assert config.runners == []
+    assert config.add_runners(RUNNERS) == ["mocked-hostname-docker"]
+    config.set_global("concurrent", None)
+    assert config.save()
+    assert RunnerConfig(config.path).runner("mocked-hostname-docker")["executor"] == "docker"